@@ -0,0 +1,90 @@
+import argparse
+import os
+import sys
+import json
+import time
+import subprocess
+import httpx
+
+'''
+ End-to-end benchmark of snyk-project-tagging.py
+ starts mock-api-server.py with a synthetic fleet, runs the tagging script against it
+ and reports wall time, API calls per endpoint and status code, and the script's peak RSS
+
+ arguments after -- are passed to snyk-project-tagging.py, e.g.
+   python benchmark.py --projects 100000 --latency-ms 50 -- --github-graphql --apply-workers 16 --snyk-rate-limit 100000
+ (the script paces itself to the real Snyk rate limit unless --snyk-rate-limit says otherwise)
+'''
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Start the mock server on a free port and return the process and its base URL
+def start_mock_server(mock_args):
+    server = subprocess.Popen([sys.executable, os.path.join(here, "mock-api-server.py"), "--listen", "127.0.0.1:0"] + mock_args,
+                              stdout=subprocess.PIPE, text=True)
+    first_line = server.stdout.readline()
+    if not first_line.startswith("listening on "):
+        server.kill()
+        raise SystemExit("mock-api-server.py did not start")
+    print(first_line.strip())
+    print(server.stdout.readline().strip())
+    return server, first_line.split()[-1]
+
+# Run the tagging script once; returns its exit code, wall time and peak RSS in bytes
+def run_tagging(base_url, script_args, log):
+    env = dict(os.environ, SNYK_TOKEN="benchmark", GITHUB_TOKEN="benchmark", SNYK_URL=f"{base_url}/rest",
+               SNYK_V1_URL=f"{base_url}/v1", GITHUB_API_URL=base_url)
+    env.pop("GITHUB_TOKENS", None)
+    started = time.perf_counter()
+    script = subprocess.Popen([sys.executable, os.path.join(here, "snyk-project-tagging.py")] + script_args, env=env, stdout=log, stderr=subprocess.STDOUT)
+    # wait4 gives the usage of this child (and the worker processes it waited for)
+    _, status, usage = os.wait4(script.pid, 0)
+    wall_time = time.perf_counter() - started
+    script.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return script.returncode, wall_time, peak_rss
+
+def print_result(run, result):
+    print(f"run {run}: exit code {result['exit_code']}, {result['wall_time']:.1f}s wall time, "
+          f"{result['api_calls']} API calls ({result['api_calls'] / result['wall_time']:.0f}/s), peak RSS {result['peak_rss'] / 2**20:.0f} MiB")
+    for name, count in sorted(result["calls"].items()):
+        print(f"  {count:>8}  {name}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark snyk-project-tagging.py against mock-api-server.py')
+    parser.add_argument('--orgs', type=int, default=10, help='Snyk orgs in the fleet (default: %(default)s)')
+    parser.add_argument('--projects', type=int, default=1000, help='Snyk projects in the fleet (default: %(default)s)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='latency the mock adds to every response (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests the mock fails with a 5xx (default: %(default)s)')
+    parser.add_argument('--rate-limit-rate', type=float, default=0, help='fraction of requests the mock answers with a 429 (default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=1,
+        help='runs against the same mock; later runs see the tags the earlier ones wrote (default: %(default)s)')
+    parser.add_argument('--mock-args', default='', help='further mock-api-server.py arguments, as one string')
+    parser.add_argument('--log', metavar='PATH', default=os.devnull, help='where the output of the tagging script goes (default: discarded)')
+    parser.add_argument('--json', metavar='PATH', help='also write the results to this file as JSON')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER, help='arguments for snyk-project-tagging.py, after --')
+    args = parser.parse_args()
+
+    mock_args = ["--orgs", str(args.orgs), "--projects", str(args.projects), "--latency-ms", str(args.latency_ms),
+                 "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate)] + args.mock_args.split()
+    script_args = args.script_args[1:] if args.script_args[:1] == ["--"] else args.script_args
+
+    server, base_url = start_mock_server(mock_args)
+    results = []
+    try:
+        with open(args.log, "a") as log:
+            for run in range(1, args.runs + 1):
+                httpx.post(f"{base_url}/_reset")
+                exit_code, wall_time, peak_rss = run_tagging(base_url, script_args, log)
+                stats = httpx.get(f"{base_url}/_stats").json()
+                result = {"run": run, "exit_code": exit_code, "wall_time": wall_time, "peak_rss": peak_rss,
+                          "api_calls": stats.pop("requests", 0), "calls": stats}
+                print_result(run, result)
+                results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump({"mock_args": mock_args, "script_args": script_args, "runs": results}, json_file, indent=2)
@@ -0,0 +1,382 @@
+import argparse
+import os
+import re
+import sys
+import json
+import time
+import random
+import threading
+import zlib
+import uuid
+import snyk
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from collections import Counter
+
+'''
+ Local stand-in for the Snyk REST/v1 and GitHub APIs that snyk-project-tagging.py calls
+ serves a synthetic fleet (orgs -> targets on GitHub repos -> projects) built from the
+ pysnyk test_data fixtures and the `test` GitHub repo fixture
+ injects latency, 429s and 5xx errors so runs can be benchmarked without production APIs
+
+ Snyk REST is served under /rest, Snyk v1 under /v1 and GitHub at the root, so point the script at it with
+   SNYK_URL=http://127.0.0.1:8765/rest SNYK_V1_URL=http://127.0.0.1:8765/v1 GITHUB_API_URL=http://127.0.0.1:8765
+ GET /_stats returns request counts per endpoint and status code, POST /_reset clears them
+'''
+orgs = 10  # Snyk orgs in the fleet
+projects = 1000  # Snyk projects in the fleet, spread evenly over the orgs
+projects_per_target = 3  # Projects imported from each target (GitHub repo)
+github_orgs = 20  # GitHub orgs the repos are spread over
+stale_fraction = 0.3  # Repos without a push for over a year
+archived_fraction = 0.1  # Repos that are archived
+missing_fraction = 0.01  # Repos GitHub answers 404 for
+page_limit = 100  # Largest page the Snyk REST API hands out
+latency = 0.0  # Seconds added to every response
+jitter = 0.0  # Up to this many seconds more, at random
+error_rate = 0.0  # Fraction of requests answered with a 5xx
+rate_limit_rate = 0.0  # Fraction of requests answered with a 429 and Retry-After
+github_quota = 5000  # GitHub requests per token per hour, reported in the X-RateLimit headers
+
+test_data = os.path.join(os.path.dirname(snyk.__file__), "test_data")
+github_fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test")
+
+stats = Counter()
+stats_lock = threading.Lock()
+project_changes = {}  # project id -> attributes changed by PATCH or deactivation
+org_indexes = {}  # org id -> org index, filled on first use
+github_usage = {}  # Authorization header -> [requests used, window reset time]
+
+def load_fixture(path):
+    with open(path) as fixture:
+        return json.load(fixture)
+
+# The fixtures every synthetic org, project, target and repo is copied from
+org_template = load_fixture(os.path.join(test_data, "organizations.json"))["orgs"][0]
+project_template = load_fixture(os.path.join(test_data, "projects.json"))["data"][0]
+target_template = load_fixture(os.path.join(test_data, "rest_targets_page1.json"))["data"][0]
+repo_template = load_fixture(github_fixture)
+
+def fraction(value, salt):
+    return zlib.crc32(f"{salt}:{value}".encode()) % 10000 / 10000
+
+# Org ids look random like real ones, so the script's hash sharding spreads them evenly
+def org_id(org_index):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, str(org_index)))
+
+def org_index_of(id):
+    if not org_indexes:
+        org_indexes.update((org_id(org_index), org_index) for org_index in range(orgs))
+    return org_indexes[id]
+
+# Projects of an org are the contiguous range [first, last) of the fleet
+def org_project_range(org_index):
+    return org_index * projects // orgs, (org_index + 1) * projects // orgs
+
+def target_id(target_index):
+    return f"00000000-0000-4000-9000-{target_index:012d}"
+
+def project_id(project_index):
+    return f"00000000-0000-4000-a000-{project_index:012d}"
+
+def repo_owner_and_name(target_index):
+    return f"mock-org-{target_index % github_orgs}", f"repo-{target_index}"
+
+def snyk_org(org_index):
+    return {"id": org_id(org_index), "type": "org",
+            "attributes": {"name": f"Mock Org {org_index}", "slug": f"mock-org-{org_index}", "is_personal": False,
+                           "group_id": (org_template.get("group") or {}).get("id")}}
+
+def snyk_target(target_index):
+    owner, name = repo_owner_and_name(target_index)
+    attributes = {key: value for key, value in target_template["attributes"].items() if key != "remoteUrl"}
+    attributes.update(displayName=f"{owner}/{name}", display_name=f"{owner}/{name}", url=f"https://github.com/{owner}/{name}")
+    return {"type": "target", "id": target_id(target_index), "attributes": attributes}
+
+def snyk_project(project_index, expand_target=False):
+    org_index = project_index * orgs // projects
+    while org_project_range(org_index)[0] > project_index:
+        org_index -= 1
+    while org_project_range(org_index)[1] <= project_index:
+        org_index += 1
+    target_index = project_index // projects_per_target
+
+    project = json.loads(json.dumps(project_template))
+    project["id"] = project_id(project_index)
+    project["attributes"]["name"] = "/".join(repo_owner_and_name(target_index)) + f":pom-{project_index}.xml"
+    project["attributes"].update(project_changes.get(project["id"], {}))
+    relationships = project["relationships"]
+    relationships["organization"]["data"]["id"] = org_id(org_index)
+    relationships["target"]["data"]["id"] = target_id(target_index)
+    relationships["target"]["links"]["related"] = f"/orgs/{org_id(org_index)}/targets/{target_id(target_index)}"
+    if expand_target:
+        relationships["target"]["data"]["attributes"] = snyk_target(target_index)["attributes"]
+    return project
+
+def github_repo(target_index):
+    owner, name = repo_owner_and_name(target_index)
+    days_since_push = 400 + target_index % 1000 if fraction(target_index, "stale") < stale_fraction else target_index % 30
+    repo = dict(repo_template)
+    repo.update(id=100000000 + target_index, name=name, full_name=f"{owner}/{name}", html_url=f"https://github.com/{owner}/{name}",
+                owner=dict(repo_template["owner"], login=owner), archived=fraction(target_index, "archived") < archived_fraction,
+                pushed_at=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - days_since_push * 86400)))
+    return repo
+
+# Target index of a GitHub repo this fleet knows, None when it doesn't exist (or is one of the missing ones)
+def github_target_index(owner, name):
+    match = re.fullmatch(r"repo-(\d+)", name)
+    if match is None:
+        return None
+    target_index = int(match[1])
+    if target_index >= (projects + projects_per_target - 1) // projects_per_target or repo_owner_and_name(target_index)[0] != owner.lower():
+        return None
+    if fraction(target_index, "missing") < missing_fraction:
+        return None
+    return target_index
+
+# A Snyk REST page of items [start, start + limit) out of total, with a cursor link to the next one
+def snyk_page(url, query, total, item):
+    limit = min(int(query.get("limit", ["10"])[0]), page_limit)
+    start = int(query.get("starting_after", ["0"])[0])
+    links = {"self": url.path[len("/rest"):] + "?" + url.query}
+    if start + limit < total:
+        next_query = {key: values[0] for key, values in query.items() if key != "starting_after"}
+        next_query.update(limit=limit, starting_after=start + limit)
+        links["next"] = url.path[len("/rest"):] + "?" + "&".join(f"{key}={value}" for key, value in next_query.items())
+    return {"jsonapi": {"version": "1.0"}, "data": [item(i) for i in range(start, min(start + limit, total))], "links": links}
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes; with Nagle on, the body waits for the client's
+    # delayed ACK on every keep-alive response and the mock adds ~40 ms to each call
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        with stats_lock:
+            stats[f"status {status}"] += 1
+
+    def count(self, endpoint):
+        with stats_lock:
+            stats[f"{self.command} {endpoint}"] += 1
+            stats["requests"] += 1
+
+    # Latency and injected failures; True when the request was answered with one
+    def inject(self):
+        time.sleep(latency + random.random() * jitter)
+        if random.random() < rate_limit_rate:
+            self.reply(429, {"message": "API rate limit exceeded"}, {"Retry-After": "1", "X-RateLimit-Remaining": "0"})
+            return True
+        if random.random() < error_rate:
+            self.reply(random.choice([500, 502, 503]), {"message": "injected server error"})
+            return True
+        return False
+
+    # GitHub's per-token hourly quota, reported on every GitHub response
+    def github_rate_limit(self):
+        now = time.time()
+        with stats_lock:
+            usage = github_usage.setdefault(self.headers.get("Authorization"), [0, now + 3600])
+            if now >= usage[1]:
+                usage[:] = [0, now + 3600]
+            usage[0] += 1
+            remaining = github_quota - usage[0]
+        headers = {"X-RateLimit-Limit": str(github_quota), "X-RateLimit-Remaining": str(max(remaining, 0)), "X-RateLimit-Reset": str(int(usage[1]))}
+        if remaining < 0:
+            self.reply(403, {"message": "API rate limit exceeded"}, headers)
+            return None
+        return headers
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        url = urlparse(re.sub("/+", "/", self.path))
+        query = parse_qs(url.query)
+        path = url.path.rstrip("/")
+
+        if path == "/_stats":
+            with stats_lock:
+                counts = dict(stats)
+            return self.reply(200, counts)
+
+        if path == "/rest/orgs":
+            self.count("/rest/orgs")
+            if not self.inject():
+                self.reply(200, snyk_page(url, query, orgs, snyk_org))
+            return
+
+        match = re.fullmatch(r"/rest/orgs/([^/]+)/projects", path)
+        if match:
+            self.count("/rest/orgs/{org_id}/projects")
+            if not self.inject():
+                first, last = org_project_range(org_index_of(match[1]))
+                project_indexes = range(first, last)
+                if "ids" in query:
+                    ids = set(query["ids"][0].split(","))
+                    project_indexes = [i for i in project_indexes if project_id(i) in ids]
+                self.reply(200, snyk_page(url, query, len(project_indexes), lambda i: snyk_project(project_indexes[i], "target" in query.get("expand", []))))
+            return
+
+        match = re.fullmatch(r"/rest/orgs/([^/]+)/projects/([^/]+)", path)
+        if match:
+            self.count("/rest/orgs/{org_id}/projects/{project_id}")
+            if not self.inject():
+                self.reply(200, {"data": snyk_project(int(match[2].rsplit("-", 1)[1]))})
+            return
+
+        match = re.fullmatch(r"/rest/orgs/([^/]+)/targets/([^/]+)", path)
+        if match:
+            self.count("/rest/orgs/{org_id}/targets/{target_id}")
+            if not self.inject():
+                self.reply(200, {"data": snyk_target(int(match[2].rsplit("-", 1)[1]))})
+            return
+
+        match = re.fullmatch(r"/repos/([^/]+)/([^/]+)", path)
+        if match:
+            self.count("/repos/{owner}/{repo}")
+            if self.inject():
+                return
+            headers = self.github_rate_limit()
+            if headers is None:
+                return
+            target_index = github_target_index(match[1], match[2])
+            if target_index is None:
+                return self.reply(404, {"message": "Not Found", "status": "404"}, headers)
+            repo = github_repo(target_index)
+            headers["ETag"] = f'"{zlib.crc32(json.dumps(repo, sort_keys=True).encode()):08x}"'
+            if self.headers.get("If-None-Match") == headers["ETag"]:
+                return self.reply(304, None, headers)
+            return self.reply(200, repo, headers)
+
+        match = re.fullmatch(r"/(orgs|users)/([^/]+)/repos", path)
+        if match:
+            self.count("/" + match[1] + "/{owner}/repos")
+            if self.inject():
+                return
+            headers = self.github_rate_limit()
+            if headers is None:
+                return
+            owner = match[2].lower()
+            if not re.fullmatch(r"mock-org-(\d+)", owner) or int(owner.rsplit("-", 1)[1]) >= github_orgs:
+                return self.reply(404, {"message": "Not Found", "status": "404"}, headers)
+            per_page = min(int(query.get("per_page", ["30"])[0]), 100)
+            page = int(query.get("page", ["1"])[0])
+            target_count = (projects + projects_per_target - 1) // projects_per_target
+            target_indexes = range(int(owner.rsplit("-", 1)[1]), target_count, github_orgs)
+            repos = [github_repo(target_index) for target_index in target_indexes[(page - 1) * per_page:page * per_page]
+                     if github_target_index(owner, f"repo-{target_index}") is not None]
+            if page * per_page < len(target_indexes):
+                headers["Link"] = f'<http://{self.headers["Host"]}{url.path}?per_page={per_page}&page={page + 1}>; rel="next"'
+            return self.reply(200, repos, headers)
+
+        self.count("unknown")
+        self.reply(404, {"message": "Not Found", "status": "404"})
+
+    def do_PATCH(self):
+        url = urlparse(re.sub("/+", "/", self.path))
+        match = re.fullmatch(r"/rest/orgs/([^/]+)/projects/([^/]+)", url.path)
+        if match is None:
+            self.count("unknown")
+            return self.reply(404, {"message": "Not Found"})
+
+        self.count("/rest/orgs/{org_id}/projects/{project_id}")
+        body = self.read_body()
+        if self.inject():
+            return
+        changes = body.get("data", {}).get("attributes", {})
+        with stats_lock:
+            project_changes.setdefault(match[2], {}).update(changes)
+        self.reply(200, {"data": snyk_project(int(match[2].rsplit("-", 1)[1]))})
+
+    def do_POST(self):
+        url = urlparse(re.sub("/+", "/", self.path))
+        if url.path == "/_reset":
+            self.read_body()
+            with stats_lock:
+                stats.clear()
+                github_usage.clear()
+            return self.reply(200, {})
+
+        body = self.read_body()
+        match = re.fullmatch(r"/v1/org/([^/]+)/project/([^/]+)/deactivate", url.path)
+        if match:
+            self.count("/v1/org/{org_id}/project/{project_id}/deactivate")
+            if not self.inject():
+                with stats_lock:
+                    project_changes.setdefault(match[2], {})["status"] = "inactive"
+                self.reply(200, {})
+            return
+
+        if url.path == "/graphql":
+            self.count("/graphql")
+            if self.inject():
+                return
+            headers = self.github_rate_limit()
+            if headers is None:
+                return
+            data, errors = {}, []
+            for alias, owner, name in re.findall(r'(\w+): repository\(owner: "([^"]+)", name: "([^"]+)"\)', body.get("query", "")):
+                target_index = github_target_index(owner, name)
+                if target_index is None:
+                    data[alias] = None
+                    errors.append({"type": "NOT_FOUND", "path": [alias], "message": f"Could not resolve to a Repository with the name '{owner}/{name}'."})
+                    continue
+                repo = github_repo(target_index)
+                data[alias] = {"pushedAt": repo["pushed_at"], "isArchived": repo["archived"], "databaseId": repo["id"], "nameWithOwner": repo["full_name"]}
+            return self.reply(200, {"data": data, "errors": errors} if errors else {"data": data}, headers)
+
+        self.count("unknown")
+        self.reply(404, {"message": "Not Found"})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock Snyk and GitHub APIs for snyk-project-tagging.py')
+    parser.add_argument('--listen', default='127.0.0.1:8765',
+        help='host:port to listen on, port 0 picks a free one (default: %(default)s)')
+    parser.add_argument('--orgs', type=int, default=orgs, help='Snyk orgs in the fleet (default: %(default)s)')
+    parser.add_argument('--projects', type=int, default=projects, help='Snyk projects in the fleet (default: %(default)s)')
+    parser.add_argument('--projects-per-target', type=int, default=projects_per_target,
+        help='projects per target/GitHub repo (default: %(default)s)')
+    parser.add_argument('--github-orgs', type=int, default=github_orgs, help='GitHub orgs the repos are spread over (default: %(default)s)')
+    parser.add_argument('--stale-fraction', type=float, default=stale_fraction, help='fraction of stale repos (default: %(default)s)')
+    parser.add_argument('--archived-fraction', type=float, default=archived_fraction, help='fraction of archived repos (default: %(default)s)')
+    parser.add_argument('--missing-fraction', type=float, default=missing_fraction, help='fraction of repos GitHub returns 404 for (default: %(default)s)')
+    parser.add_argument('--latency-ms', type=float, default=latency * 1000, help='latency added to every response (default: %(default)s)')
+    parser.add_argument('--jitter-ms', type=float, default=jitter * 1000, help='random extra latency up to this much (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=error_rate, help='fraction of requests answered with a 5xx (default: %(default)s)')
+    parser.add_argument('--rate-limit-rate', type=float, default=rate_limit_rate, help='fraction of requests answered with a 429 (default: %(default)s)')
+    parser.add_argument('--github-quota', type=int, default=github_quota, help='GitHub requests per token per hour (default: %(default)s)')
+    parser.add_argument('--seed', type=int, help='seed for the injected latency and failures')
+    args = parser.parse_args()
+
+    orgs = args.orgs
+    projects = args.projects
+    projects_per_target = args.projects_per_target
+    github_orgs = args.github_orgs
+    stale_fraction = args.stale_fraction
+    archived_fraction = args.archived_fraction
+    missing_fraction = args.missing_fraction
+    latency = args.latency_ms / 1000
+    jitter = args.jitter_ms / 1000
+    error_rate = args.error_rate
+    rate_limit_rate = args.rate_limit_rate
+    github_quota = args.github_quota
+    random.seed(args.seed)
+
+    host, port = args.listen.rsplit(":", 1)
+    server = ThreadingHTTPServer((host, int(port)), MockHandler)
+    server.daemon_threads = True
+    # the benchmark reads the address from this line
+    print(f"listening on http://{host}:{server.server_address[1]}", flush=True)
+    print(f"{orgs} orgs, {projects} projects on {(projects + projects_per_target - 1) // projects_per_target} repos in {github_orgs} GitHub orgs", flush=True)
+    server.serve_forever()
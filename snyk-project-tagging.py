@@ -1,12 +1,36 @@
 import argparse
 import snyk
 import os
-from urllib.parse import quote
+from urllib.parse import quote, urlparse, parse_qs
 import urllib
 import http
 import httpx
+import requests
 import json
+import re
+import time
+import threading
+import queue
+import zlib
+import itertools
+import multiprocessing
+import calendar
+import hmac
+import hashlib
+import ipaddress
+import statistics
+import sqlite3
+import sys
+import cProfile
+import pstats
+import tracemalloc
+import resource
+from array import array
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import Counter, deque
+from contextlib import contextmanager
 from datetime import date, timedelta, datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import pprint
 
 '''
@@ -17,20 +41,1010 @@ Description: Program meant to:
 '''
 token = os.getenv('SNYK_TOKEN') # Set your API token as an environment variable
 github_token = os.getenv('GITHUB_TOKEN')
-snyk_url = "https://api.us.snyk.io/rest" #os.getenv('SNYK_URL')
-v1_snyk_url = "https://api.us.snyk.io/v1" #os.getenv('SNYK_URL')
+github_tokens = os.getenv('GITHUB_TOKENS')  # Optional comma-separated pool of extra GitHub tokens
+github_app_id = os.getenv('GITHUB_APP_ID')  # GitHub App used instead of (or with) tokens, with its private key file
+github_app_key_file = os.getenv('GITHUB_APP_PRIVATE_KEY_FILE')
+snyk_url = os.getenv('SNYK_URL', "https://api.us.snyk.io/rest")  # Overridable to run against mock-api-server.py
+v1_snyk_url = os.getenv('SNYK_V1_URL', "https://api.us.snyk.io/v1")
 apiVersion = "2024-10-15"  # Set the API version. Needs ~beta endpoint at stated version or later
 
 tries = 4  # Number of retries
 delay = 1  # Delay between retries
 backoff = 2  # Backoff factor
 
-all_remote_repo_urls = []
-all_snyk_targets = []
+github_url = os.getenv('GITHUB_API_URL', "https://api.github.com")
+github_workers = 16  # Number of concurrent GitHub repo lookups (and pooled connections)
+github_graphql = False  # Look repos up through the GraphQL API in aliased batches instead of one REST call each
+github_graphql_batch = 100  # Repos per GraphQL query
+github_org_sweep = False  # List whole GitHub orgs up front and only look up the repos the sweep missed
+github_org_sweep_min_repos = 5  # Only sweep GitHub orgs with at least this many Snyk targets
+github_cache_file = None  # On-disk repo status cache, enabled by --github-cache
+github_cache_ttl = 24 * 60 * 60  # Seconds a cached status is trusted before it is revalidated with its ETag
+github_cache_max_entries = 200000  # Oldest entries are evicted past this size
+stale_days = 90  # Repos without a push for longer than this are tagged inactive
+org_stale_days = {}  # GitHub org -> its own stale_days, set by --org-stale-days
+staleness_buckets = [7, 30, 90, 180, 365, 730, 1095]  # Upper bounds (days since push) of the staleness report histogram
+repo_index_file = None  # Where the repo index is saved after the lookups, set by --repo-index
+incremental = False  # Only look up repos that are new, due to turn stale, or older than incremental_max_age
+incremental_max_age = 7 * 24 * 60 * 60  # Seconds after which a repo is looked up again regardless of its due date
+pipeline_queue_size = 1000  # Items held between two pipeline stages before the upstream stage waits
+lookup_batch_window = 0.5  # Seconds the resolve stage waits for github_graphql_batch new repos before looking up fewer
+snyk_apply_workers = 8  # Concurrent Snyk project writes (and pooled connections)
+snyk_deactivate_workers = 4  # Concurrent project deactivations, apart from the apply workers
+deactivation_verify_batch = 100  # Project ids per listing that verifies deactivations
+snyk_rate_limit = 1620  # Snyk API requests per minute per token
+github_rate_reserve = 50  # GitHub requests kept back from the reported quota for requests still in flight
+rate_limit_retries = 5  # Times a rate-limited request is retried after waiting
+connect_timeout = 10  # Seconds to connect to an API
+read_timeout = 60  # Seconds to wait for each read of a response, or for a pooled connection
+request_deadline = 300  # Seconds a request may take in total, retries and hedges included; rate limit waits don't count
+hedge_percentile = 95  # A GET or PATCH slower than this percentile of its endpoint's recent latencies gets a second try; 0 turns hedging off
+hedge_min_samples = 20  # Latencies an endpoint needs before its requests are hedged
+hedge_window = 500  # Recent latencies per endpoint the hedge thresholds are computed from
+journal_file = None  # Checkpoint journal of the run, set by --journal
+mode = "run"  # run: read and write in one pass; plan: only write the change plan; apply: only execute a plan
+plan_file = "snyk-tagging-plan.jsonl"  # Change plan written by plan mode and read by apply mode
+webhook_listen = "127.0.0.1:8080"  # host:port the webhook receiver listens on
+webhook_secret = os.getenv('GITHUB_WEBHOOK_SECRET')  # Secret the GitHub webhook signs its payloads with
+daemon_reconcile_interval = 15 * 60  # Seconds between reconciliations in daemon mode
+daemon_full_refresh = 24 * 60 * 60  # Seconds a trusted org listing is served before the org is re-listed
+trust_inventory = False  # Serve orgs from the inventory instead of re-listing them, set by --trust-inventory
+shard_index, shard_count = 0, 1  # This machine's share of the group's orgs, set by --shard i/N
+shard_processes = 1  # Worker processes splitting this machine's shard, set by --processes
+shard_process = 0  # Which of those processes this is
+summary_file = None  # Where the run summary is written as JSON, set by --summary-file
+profile_dir = None  # Run directory for cProfile dumps and tracemalloc snapshots, set by --profile
+profile_max_snapshots = 50  # tracemalloc snapshots taken at most, so long daemon runs don't fill the disk
+metrics_file = None  # Prometheus textfile the run's metrics are written to, set by --metrics-file
+inventory_db_file = None  # SQLite inventory of orgs, targets, projects and repo statuses, set by --inventory-db
+log_file = None  # JSONL event log, set by --log-file; events go to stdout otherwise
+log_level = "info"  # Events below this level are dropped before they are formatted, set by --log-level
+progress_interval = 5  # Seconds between progress updates; 0 turns them off
 
-remote_repos_scanned = []
-remote_repos_stale = []
-remote_repos_archived = []
+# Canonical key for a repo URL: https, ssh and .git variants of one repo all map to "host/owner/name"
+def normalize_repo_url(repo_url):
+    repo_url = repo_url.strip()
+    if repo_url.startswith("git@"):
+        host, _, path = repo_url[len("git@"):].partition(":")
+    else:
+        parsed = urlparse(repo_url if "://" in repo_url else "https://" + repo_url)
+        host, path = parsed.hostname or "", parsed.path
+    return f"{host}/{path.strip('/').removesuffix('.git')}".lower()
+
+# Owner and name of a GitHub repo URL, whatever form the URL is in
+def github_repo_name(repo_url):
+    github_Org, repo_name = normalize_repo_url(repo_url).split("/")[-2:]
+    return github_Org, repo_name
+
+'''
+The repo statuses collected this run, one row per repo in parallel arrays (push time, archived
+flag, GitHub org id) so a whole batch is classified in one pass over the columns. A repo that is
+recorded again gets a new row and its old one is marked dead (org id -1); once dead rows are the
+majority, the columns are compacted, so a long-running daemon's columns stay as long as its repos.
+'''
+class RepoStatusColumns:
+    def __init__(self):
+        self.keys = []
+        self.pushed_at = array("d")  # epoch seconds
+        self.archived = array("b")
+        self.org_ids = array("l")
+        self.org_names = []  # org id -> GitHub org
+        self.org_ids_by_name = {}
+        self.rows = {}  # key -> its live row
+        self.classified = 0  # rows before this one have been classified
+
+    def append(self, key, pushed_at, archived):
+        self.drop(key)
+        if len(self.keys) >= 1024 and len(self.rows) * 2 < len(self.keys):
+            self.compact()
+        org = key.rsplit("/", 2)[-2]
+        if org not in self.org_ids_by_name:
+            self.org_ids_by_name[org] = len(self.org_names)
+            self.org_names.append(org)
+        self.rows[key] = len(self.keys)
+        self.keys.append(key)
+        self.pushed_at.append(pushed_at)
+        self.archived.append(archived)
+        self.org_ids.append(self.org_ids_by_name[org])
+
+    def drop(self, key):
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self.org_ids[row] = -1
+
+    # Rewrite the columns with only the live rows, in the same order
+    def compact(self):
+        live = sorted(self.rows.values())
+        self.classified = sum(1 for row in live if row < self.classified)
+        self.keys = [self.keys[row] for row in live]
+        self.pushed_at = array("d", (self.pushed_at[row] for row in live))
+        self.archived = array("b", (self.archived[row] for row in live))
+        self.org_ids = array("l", (self.org_ids[row] for row in live))
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+
+    # Classify rows start.. (default: those not classified yet) against their org's threshold.
+    # Returns the rows' keys, stale flags and due times, and per org a Counter of days since push.
+    def classify(self, now, start=None):
+        start = self.classified if start is None else start
+        thresholds = array("l", (org_stale_days.get(org, stale_days) for org in self.org_names))
+        org_ids = self.org_ids[start:]
+        pushed_at = self.pushed_at[start:]
+        days = array("l", (int(now - pushed) // 86400 for pushed in pushed_at))
+        row_thresholds = array("l", (thresholds[org_id] for org_id in org_ids))
+        stale = [day > threshold for day, threshold in zip(days, row_thresholds)]
+        due_at = [pushed + (threshold + 1) * 86400 for pushed, threshold in zip(pushed_at, row_thresholds)]
+        self.classified = len(self.keys)
+
+        live = [i for i, org_id in enumerate(org_ids) if org_id >= 0]
+        days_by_org = {}
+        for i in live:
+            days_by_org.setdefault(self.org_names[org_ids[i]], Counter())[days[i]] += 1
+        return [(self.keys[start + i], stale[i], due_at[i]) for i in live], days_by_org
+
+    # Per GitHub org: repos, stale and archived counts, and days since push of the whole run
+    def report(self, now):
+        classified, days_by_org = self.classify(now, 0)
+        report = {org: {"repos": sum(days.values()), "stale": 0, "archived": 0, "days": dict(days)} for org, days in days_by_org.items()}
+        for key, stale, _ in classified:
+            row = self.rows[key]
+            org_report = report[self.org_names[self.org_ids[row]]]
+            org_report["stale"] += stale
+            org_report["archived"] += self.archived[row]
+        return report
+
+'''
+Every repo URL seen in the run, keyed by normalize_repo_url, with its GitHub status.
+Repos are also indexed by GitHub repo id: when a repo is renamed, the old and new URLs
+resolve to the same entry.
+'''
+class RepoIndex:
+    def __init__(self):
+        self.repos = {}  # key -> {"url", "repo_id", "pushed_at", "archived", "stale", "checked_at", "due_at"}
+        self.aliases = {}  # old or variant key -> key in self.repos
+        self.keys_by_id = {}  # GitHub repo id -> key in self.repos
+        self.added = set()  # keys added during this run
+        self.statuses = RepoStatusColumns()
+
+    def key(self, repo_url):
+        key = normalize_repo_url(repo_url)
+        return self.aliases.get(key, key)
+
+    # True the first time a repo is added in this run
+    def add(self, repo_url):
+        key = self.key(repo_url)
+        if key in self.added:
+            return False
+        self.added.add(key)
+        self.repos.setdefault(key, {"url": repo_url})
+        return True
+
+    def __contains__(self, repo_url):
+        return self.key(repo_url) in self.repos
+
+    def __len__(self):
+        return len(self.repos)
+
+    def get(self, repo_url):
+        return self.repos.get(self.key(repo_url))
+
+    # Stale and due_at are filled in by classify(), once per batch of recorded statuses
+    def record_status(self, repo_url, pushed_at, archived, repo_id=None, full_name=None):
+        key = self.key(repo_url)
+        entry = self.repos.pop(key, {"url": repo_url})
+
+        # GitHub answers for renamed repos under their new name; file the entry under that
+        new_key = key
+        if full_name:
+            new_key = key.rsplit("/", 2)[0] + "/" + full_name.lower()
+        if repo_id is not None and repo_id in self.keys_by_id and self.keys_by_id[repo_id] != new_key:
+            old_key = self.keys_by_id[repo_id]
+            entry = {**self.repos.pop(old_key, {}), **entry}
+            self.alias(old_key, new_key)
+            self.statuses.drop(old_key)
+        if new_key != key:
+            entry = {**self.repos.pop(new_key, {}), **entry}
+            self.alias(key, new_key)
+            if key in self.added:
+                self.added.add(new_key)
+
+        entry.update({"repo_id": repo_id, "pushed_at": pushed_at, "archived": archived, "checked_at": time.time()})
+        self.repos[new_key] = entry
+        self.statuses.drop(key)
+        self.statuses.append(new_key, datetime.fromisoformat(pushed_at.replace("Z", "+00:00")).timestamp(), archived)
+        if repo_id is not None:
+            self.keys_by_id[repo_id] = new_key
+
+    # Set stale and due_at (the moment an active repo turns stale if nobody pushes to it before
+    # then) on every repo recorded since the last call
+    def classify(self):
+        classified, _ = self.statuses.classify(time.time())
+        for key, stale, due_at in classified:
+            self.repos[key].update(stale=stale, due_at=due_at)
+        if classified:
+            event_log.log("debug", "repos classified", repos=len(classified), stale=sum(stale for _, stale, _ in classified))
+
+    # Whether an incremental run has to ask GitHub about this repo again
+    def needs_refresh(self, repo_url, now):
+        entry = self.get(repo_url)
+        if entry is None or "due_at" not in entry:
+            return True
+        if not entry["stale"] and now >= entry["due_at"]:
+            return True
+        return now - entry["checked_at"] > incremental_max_age
+
+    def alias(self, old_key, new_key):
+        self.aliases[old_key] = new_key
+        for key, target in self.aliases.items():
+            if target == old_key:
+                self.aliases[key] = new_key
+
+    def is_stale(self, repo_url):
+        return bool(self.repos.get(self.key(repo_url), {}).get("stale"))
+
+    def is_archived(self, repo_url):
+        return bool(self.repos.get(self.key(repo_url), {}).get("archived"))
+
+    def save(self, path):
+        with open(path + ".tmp", "w") as index_file:
+            json.dump({"repos": self.repos, "aliases": self.aliases}, index_file)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path):
+        if os.path.exists(path):
+            with open(path) as index_file:
+                saved = json.load(index_file)
+            self.repos.update(saved["repos"])
+            self.aliases.update(saved["aliases"])
+            for key, entry in self.repos.items():
+                if entry.get("repo_id") is not None:
+                    self.keys_by_id[entry["repo_id"]] = key
+            event_log.log("info", "repo index loaded", path=path, repos=len(self.repos))
+
+'''
+Token bucket shared by every worker calling one API. Until the API reports its quota it refills
+at a fixed rate; once X-RateLimit-Remaining/Reset arrive the bucket holds what the API says is
+left and refills when the quota window resets. Retry-After (or an exhausted quota) pauses all
+callers, and rate-limit responses without either halve the fixed rate.
+'''
+class RateLimiter:
+    def __init__(self, name, rate, burst, reserve=0, share=1.0):
+        self.name = name
+        self.share = share  # fraction of the reported quota this process may use (one shard's budget)
+        self.rate = rate * share  # tokens per second while the API hasn't reported its quota
+        self.max_rate = self.rate
+        self.burst = max(burst * share, 1)
+        self.tokens = self.burst
+        self.reserve = reserve
+        self.refilled = time.monotonic()
+        self.limit = None  # quota per window, from X-RateLimit-Limit
+        self.reset_at = None  # epoch seconds the quota window resets, from X-RateLimit-Reset
+        self.resume_at = 0.0  # epoch seconds before which no request is sent
+        self.slept = 0.0  # seconds callers spent waiting, summed over all threads
+        self.lock = threading.Lock()
+
+    # Wait for a token; returns the seconds waited
+    def acquire(self):
+        waited = 0
+        while True:
+            with self.lock:
+                wait = self.take()
+                if wait <= 0:
+                    return waited
+                self.slept += wait
+            time.sleep(wait)
+            waited += wait
+
+    # Spend a token if there is one right now, without waiting
+    def try_acquire(self):
+        with self.lock:
+            return self.take() <= 0
+
+    # Spend a token and return 0, or return how long to wait before trying again
+    def take(self):
+        now = time.time()
+        if now < self.resume_at:
+            return self.resume_at - now
+
+        if self.reset_at is not None and now >= self.reset_at:
+            # new quota window; run on the fixed rate until the API reports again
+            self.tokens = (self.limit - self.reserve) * self.share
+            self.reset_at = None
+            self.refilled = time.monotonic()
+
+        if self.reset_at is not None:
+            if self.tokens < 1:
+                return self.reset_at - now
+        else:
+            monotonic = time.monotonic()
+            self.tokens = max(self.tokens, min(self.burst, self.tokens + (monotonic - self.refilled) * self.rate))
+            self.refilled = monotonic
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+
+        self.tokens -= 1
+        return 0
+
+    # Tune the bucket from a response; True when the request was rate limited and should be retried
+    def update(self, headers, status_code):
+        now = time.time()
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        limit = headers.get("X-RateLimit-Limit")
+        retry_after = headers.get("Retry-After")
+
+        with self.lock:
+            if remaining is not None and reset is not None:
+                self.tokens = (int(remaining) - self.reserve) * self.share
+                self.reset_at = float(reset)
+                self.limit = int(limit) if limit is not None else max(self.limit or 0, int(remaining))
+
+            if status_code == 429 or (status_code == 403 and (retry_after is not None or remaining == "0")):
+                if retry_after is not None and retry_after.isdigit():
+                    self.resume_at = max(self.resume_at, now + int(retry_after))
+                elif remaining == "0" and reset is not None:
+                    self.resume_at = max(self.resume_at, float(reset))
+                else:
+                    self.rate = max(self.rate / 2, 0.1)
+                    self.resume_at = max(self.resume_at, now + 1 / self.rate)
+                event_log.log("warning", "rate limited", limiter=self.name, status=status_code, wait=round(max(self.resume_at - now, 0), 1))
+                return True
+
+            self.rate = min(self.rate * 1.05, self.max_rate)
+            return False
+
+'''
+Instrumentation of a run: API calls by API, endpoint family, phase and status code, their latency
+histograms, retries, and the span each phase ran for. The phase is per thread, set by timed_phase.
+snapshot() goes into the run summary, so worker processes and shards add up before the metrics
+are printed or written as a Prometheus textfile.
+'''
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]  # Upper bounds (seconds) of the latency histograms
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.calls = Counter()  # (api, endpoint, phase, status) -> calls
+        self.latency = {}  # (api, endpoint, phase) -> [count per bucket ..., count over the last bucket, sum of seconds]
+        self.retries = Counter()  # (api, endpoint, reason) -> retries
+        self.phases = {}  # phase -> [first start, last end], over all threads that ran it
+        self.recent = {}  # (api, endpoint) -> latencies of the latest answered calls, for the hedge thresholds
+        self.thresholds = {}  # (api, endpoint, percentile) -> [threshold, samples it was computed at]
+        self.samples = Counter()  # (api, endpoint) -> answered calls so far
+        self.started = time.time()
+
+    def phase(self):
+        return getattr(self.local, "phase", "main")
+
+    def set_phase(self, phase):
+        self.local.phase = phase
+
+    @contextmanager
+    def timed_phase(self, phase):
+        previous = self.phase()
+        self.local.phase = phase
+        started = time.time()
+        profiled = start_phase_profile(phase)
+        try:
+            yield
+        finally:
+            stop_phase_profile(phase, profiled)
+            self.local.phase = previous
+            with self.lock:
+                span = self.phases.setdefault(phase, [started, started])
+                span[0] = min(span[0], started)
+                span[1] = max(span[1], time.time())
+
+    def record_call(self, api, endpoint, status, seconds):
+        phase = self.phase()
+        bucket = next((i for i, bound in enumerate(latency_buckets) if seconds <= bound), len(latency_buckets))
+        with self.lock:
+            self.calls[(api, endpoint, phase, str(status))] += 1
+            histogram = self.latency.setdefault((api, endpoint, phase), [0] * (len(latency_buckets) + 2))
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+            if isinstance(status, int) and status < 500:
+                self.recent.setdefault((api, endpoint), deque(maxlen=hedge_window)).append(seconds)
+                self.samples[(api, endpoint)] += 1
+
+    # The given percentile of the endpoint's recent latencies, None until it has hedge_min_samples;
+    # recomputed every 5% of the window, so it follows the endpoint without sorting on every call
+    def latency_percentile(self, api, endpoint, percentile):
+        with self.lock:
+            samples = self.samples[(api, endpoint)]
+            if samples < hedge_min_samples:
+                return None
+            cached = self.thresholds.get((api, endpoint, percentile))
+            if cached is None or samples - cached[1] >= max(hedge_window // 20, 1):
+                latencies = sorted(self.recent[(api, endpoint)])
+                cached = self.thresholds[(api, endpoint, percentile)] = [latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)], samples]
+            return cached[0]
+
+    def record_retry(self, api, endpoint, reason):
+        with self.lock:
+            self.retries[(api, endpoint, reason)] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "calls": [[*key, count] for key, count in self.calls.items()],
+                "latency": [[*key, histogram] for key, histogram in self.latency.items()],
+                "retries": [[*key, count] for key, count in self.retries.items()],
+                "phases": {phase: end - start for phase, (start, end) in self.phases.items()},
+                "wall_time": time.time() - self.started,
+            }
+
+metrics = Metrics()
+
+'''
+Structured event log: one JSON object per line with ts, level, event, phase and the event's own
+fields. log() only checks the level and queues the record; a background thread formats and
+writes them in batches, so workers never wait on the disk or the terminal. Every
+progress_interval seconds the same thread redraws a progress line on stderr, or logs it as a
+progress event when stderr is not a terminal. Whole payloads are only logged at debug level.
+'''
+log_levels = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+class EventLog:
+    def __init__(self):
+        self.level = log_levels["info"]
+        self.records = queue.Queue()
+        self.output = sys.stdout
+        self.thread = None
+        self.progress_line = None  # what the progress line on the terminal shows right now
+        self.progress_on_terminal = False
+
+    def enabled(self, level):
+        return log_levels[level] >= self.level
+
+    def log(self, level, event, **fields):
+        if log_levels[level] >= self.level:
+            self.records.put((time.time(), level, event, metrics.phase(), fields))
+
+    # A new queue and writer thread each time, as a forked worker process gets neither from its parent
+    def start(self, path=None, level="info", progress_on_terminal=True):
+        self.level = log_levels[level]
+        self.records = queue.Queue()
+        self.output = open(path, "a") if path else sys.stdout
+        self.progress_on_terminal = progress_on_terminal and sys.stderr.isatty()
+        self.thread = threading.Thread(target=self.write_records, name="event log", daemon=True)
+        self.thread.start()
+
+    # Write out everything logged so far and stop the writer thread
+    def stop(self):
+        if self.thread is None:
+            return
+        self.records.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.output is not sys.stdout:
+            self.output.close()
+            self.output = sys.stdout
+
+    def write_records(self):
+        next_progress = time.time() + progress_interval if progress_interval else None
+        finished = False
+        while not finished:
+            try:
+                batch = [self.records.get(timeout=max(next_progress - time.time(), 0) if next_progress else None)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < 1000:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for record in batch:
+                if record is None:
+                    finished = True
+                    continue
+                ts, level, event, phase, fields = record
+                lines.append(json.dumps({"ts": round(ts, 3), "level": level, "event": event, "phase": phase, **fields}, default=str))
+            if lines:
+                self.write_lines(lines)
+
+            if next_progress and (finished or time.time() >= next_progress):
+                self.show_progress(final=finished)
+                next_progress = time.time() + progress_interval
+
+    def write_lines(self, lines):
+        # the progress line is redrawn below the records when both go to the terminal
+        redraw = self.progress_line is not None and self.output.isatty()
+        if redraw:
+            sys.stderr.write("\r\033[K")
+            sys.stderr.flush()
+        self.output.write("\n".join(lines) + "\n")
+        self.output.flush()
+        if redraw:
+            sys.stderr.write(self.progress_line)
+            sys.stderr.flush()
+
+    def show_progress(self, final=False):
+        progress = run_progress()
+        if not self.progress_on_terminal:
+            self.write_lines([json.dumps({"ts": round(time.time(), 3), "level": "info", "event": "progress", "phase": "main", **progress})])
+            return
+        self.progress_line = (f"{progress['projects']} projects ({progress['projects_per_second']}/s), {progress['writes']} writes, "
+                              f"{progress['skipped']} skipped, {progress['failed']} failed, {progress['repos']} repos looked up, "
+                              f"{progress['api_calls']} API calls")
+        sys.stderr.write("\r\033[K" + self.progress_line + ("\n" if final else ""))
+        sys.stderr.flush()
+        if final:
+            self.progress_line = None
+
+# Counters of the run so far, for the progress line
+def run_progress():
+    elapsed = max(time.time() - metrics.started, 0.001)
+    with metrics.lock:
+        api_calls = sum(metrics.calls.values())
+    return {
+        "projects": run_stats["projects"],
+        "projects_per_second": round(run_stats["projects"] / elapsed, 1),
+        "writes": run_stats["project writes"],
+        "skipped": run_stats["project writes skipped"],
+        "failed": len(project_errors),
+        "repos": run_stats["repos looked up"],
+        "api_calls": api_calls,
+    }
+
+event_log = EventLog()
+
+'''
+--profile: a cProfile dump per phase (the profiles of all threads that ran it, added up) and a
+tracemalloc snapshot when the first thread enters and the last one leaves each phase, with the
+peak RSS so far. Python 3.12 allows only one profiler at a time, which sees every thread, so
+there the whole run is profiled as one.
+'''
+profiles = {}  # phase -> profiles of the threads that ran it
+phase_threads = Counter()  # phase -> threads in it right now
+profile_snapshots = []  # (label, traced memory, traced peak, peak RSS) of every snapshot taken
+profile_lock = threading.Lock()
+profile_local = threading.local()
+run_profile = None  # the one profile of the run where profiles can't be per thread
+previous_snapshot = None
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+def start_profiling():
+    global run_profile
+    if profile_dir is None:
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    tracemalloc.start()
+    if sys.version_info >= (3, 12):
+        run_profile = cProfile.Profile()
+        run_profile.enable()
+    take_snapshot("run start")
+
+# Write the top allocations (and the growth since the previous snapshot) under profile_dir
+def take_snapshot(label):
+    global previous_snapshot
+    if len(profile_snapshots) >= profile_max_snapshots:
+        return
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    current, peak = tracemalloc.get_traced_memory()
+    profile_snapshots.append((label, current, peak, peak_rss()))
+
+    path = os.path.join(profile_dir, f"memory-{len(profile_snapshots):02d}-{label.replace(' ', '-')}.txt")
+    with open(path, "w") as report:
+        report.write(f"{label}: {current / 2**20:.1f} MiB traced, {peak / 2**20:.1f} MiB traced peak, {profile_snapshots[-1][3] / 2**20:.1f} MiB peak RSS\n\n")
+        report.write("top allocations:\n")
+        for stat in snapshot.statistics("lineno")[:25]:
+            report.write(f"  {stat}\n")
+        if previous_snapshot is not None:
+            report.write("\ngrowth since the previous snapshot:\n")
+            for stat in snapshot.compare_to(previous_snapshot, "lineno")[:10]:
+                report.write(f"  {stat}\n")
+    previous_snapshot = snapshot
+
+# Profile this thread for the phase, pausing the profile of a phase it is nested in
+def start_phase_profile(phase):
+    if profile_dir is None:
+        return None
+    with profile_lock:
+        phase_threads[phase] += 1
+        if phase_threads[phase] == 1:
+            take_snapshot(f"{phase} start")
+    if run_profile is not None:
+        return None
+
+    outer = getattr(profile_local, "profile", None)
+    if outer is not None:
+        outer.disable()
+    profile = cProfile.Profile()
+    profile.enable()
+    profile_local.profile = profile
+    return profile, outer
+
+def stop_phase_profile(phase, profiled):
+    if profile_dir is None:
+        return
+    if profiled is not None:
+        profile, outer = profiled
+        profile.disable()
+        profile_local.profile = outer
+        if outer is not None:
+            outer.enable()
+    with profile_lock:
+        if profiled is not None:
+            profiles.setdefault(phase, []).append(profiled[0])
+        phase_threads[phase] -= 1
+        if phase_threads[phase] == 0:
+            take_snapshot(f"{phase} end")
+
+# Dump the profiles (binary for pstats/snakeviz, and the top functions as text) and the memory summary
+def finish_profiling():
+    if profile_dir is None:
+        return
+    if run_profile is not None:
+        run_profile.disable()
+        phase_profiles = {"run": [run_profile]}
+    else:
+        phase_profiles = profiles
+    for phase, phase_profile_list in phase_profiles.items():
+        stats = pstats.Stats(phase_profile_list[0])
+        for profile in phase_profile_list[1:]:
+            stats.add(profile)
+        stats.dump_stats(os.path.join(profile_dir, f"cpu-{phase}.prof"))
+        with open(os.path.join(profile_dir, f"cpu-{phase}.txt"), "w") as report:
+            stats.stream = report
+            stats.sort_stats("cumulative").print_stats(40)
+
+    take_snapshot("run end")
+    tracemalloc.stop()
+    with open(os.path.join(profile_dir, "memory.json"), "w") as memory:
+        json.dump([{"snapshot": label, "traced": current, "traced_peak": peak, "peak_rss": rss}
+                   for label, current, peak, rss in profile_snapshots], memory, indent=2)
+    event_log.log("info", "profiles written", path=profile_dir, phases=len(phase_profiles), peak_rss=peak_rss())
+
+# Endpoint family of an API URL, its path with the ids taken out, e.g. /rest/orgs/{id}/projects
+def endpoint_family(api, url):
+    path = urlparse(str(url)).path.rstrip("/") or "/"
+    if api == "github":
+        path = re.sub(r"^/repos/[^/]+/[^/]+", "/repos/{owner}/{repo}", path)
+        path = re.sub(r"^/(orgs|users)/[^/]+", r"/\1/{owner}", path)
+        return re.sub(r"/installations/\d+", "/installations/{id}", path)
+    # Snyk paths alternate collection and id after the /rest or /v1 prefix
+    parts = [part for part in path.split("/") if part]
+    return "/" + "/".join(part if i == 0 or i % 2 == 1 else "{id}" for i, part in enumerate(parts))
+
+'''
+Deadlines and hedging: each try of a request, body included, runs on the request pool, so the
+caller stops waiting at the request's deadline even when a connection hangs. A GET or PATCH still unanswered
+after hedge_percentile of its endpoint's recent latencies gets a second try if the limiter has a
+token to spare; the first answer wins and the other one is closed when it arrives.
+'''
+request_pool = None
+request_pool_lock = threading.Lock()
+
+def get_request_pool():
+    global request_pool
+    with request_pool_lock:
+        if request_pool is None:
+            # every caller can have a try and a hedge in flight
+            request_pool = ThreadPoolExecutor(max_workers=2 * (github_workers + snyk_apply_workers + snyk_deactivate_workers) + 8,
+                                              thread_name_prefix="request")
+    return request_pool
+
+def http_timeout():
+    return httpx.Timeout(read_timeout, connect=connect_timeout)
+
+def close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+# Run send() (one try of a request) by the deadline, hedged as described above; raises
+# TimeoutError once the deadline passes
+def hedged_send(api, endpoint, method, send, deadline, limiter):
+    phase = metrics.phase()
+    def run():
+        metrics.set_phase(phase)
+        return send()
+
+    pool = get_request_pool()
+    first = pool.submit(run)
+    attempts = [first]
+    threshold = metrics.latency_percentile(api, endpoint, hedge_percentile) if hedge_percentile and method in ("GET", "PATCH") else None
+    hedge_at = time.monotonic() + threshold if threshold is not None else None
+    failure = None
+    while attempts:
+        done, _ = wait(attempts, timeout=max(min(deadline, hedge_at or deadline) - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+        for future in done:
+            attempts.remove(future)
+            if future.exception() is None:
+                for other in attempts:
+                    other.add_done_callback(close_response)
+                if future is not first:
+                    metrics.record_retry(api, endpoint, "hedge won")
+                return future.result()
+            failure = future.exception()
+        if done:
+            continue
+
+        now = time.monotonic()
+        if now >= deadline:
+            for other in attempts:
+                other.add_done_callback(close_response)
+            raise TimeoutError(f"no response within the {request_deadline:.0f}s deadline")
+        if hedge_at is not None and now >= hedge_at:
+            hedge_at = None
+            if limiter.try_acquire():
+                metrics.record_retry(api, endpoint, "hedge")
+                attempts.append(pool.submit(run))
+    raise failure
+
+# httpx transport pacing requests with a limiter and recording them in the metrics. Rate-limited
+# requests are retried after the wait; 5xx responses and connection errors up to tries times,
+# with delay/backoff, within the request's deadline.
+class RateLimitedTransport(httpx.HTTPTransport):
+    def __init__(self, limiter, api, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+        self.api = api
+
+    # Limiter of the next try of the request
+    def prepare(self, request):
+        return self.limiter
+
+    # One try, read to the end here (httpx would read the body after the transport returns), so the
+    # deadline, the hedge and the recorded latency cover the whole response
+    def send(self, request, endpoint):
+        started = time.monotonic()
+        try:
+            response = super().handle_request(request)
+            try:
+                response.read()
+            finally:
+                response.close()
+        except httpx.TransportError:
+            metrics.record_call(self.api, endpoint, "error", time.monotonic() - started)
+            raise
+        metrics.record_call(self.api, endpoint, response.status_code, time.monotonic() - started)
+        return response
+
+    def handle_request(self, request):
+        endpoint = endpoint_family(self.api, request.url)
+        deadline = time.monotonic() + request_deadline
+        rate_limited = server_errors = 0
+        while True:
+            limiter = self.prepare(request)
+            deadline += limiter.acquire()
+            try:
+                response = hedged_send(self.api, endpoint, request.method, lambda: self.send(request, endpoint), deadline, limiter)
+            except TimeoutError as e:
+                raise httpx.TimeoutException(str(e), request=request)
+            except httpx.TransportError:
+                if server_errors >= tries - 1 or time.monotonic() >= deadline:
+                    raise
+                reason = "connection error"
+            else:
+                if limiter.update(response.headers, response.status_code) and rate_limited < rate_limit_retries:
+                    rate_limited += 1
+                    metrics.record_retry(self.api, endpoint, "rate limit")
+                    response.close()
+                    continue
+                if response.status_code < 500 or server_errors >= tries - 1 or time.monotonic() >= deadline:
+                    return response
+                reason = "server error"
+                response.close()
+            metrics.record_retry(self.api, endpoint, reason)
+            time.sleep(min(delay * backoff ** server_errors, max(deadline - time.monotonic(), 0)))
+            server_errors += 1
+
+# A GitHub token with its own rate limiter; owner is the only org it can read, None for any org
+class GitHubCredential:
+    def __init__(self, name, token=None, owner=None):
+        self.name = name
+        self.token = token
+        self.owner = owner
+        self.limiter = None  # set by create_limiters
+
+    def authorization(self):
+        return f"Bearer {self.token}" if self.token else None
+
+# GitHub App installation token, minted from the App's JWT and renewed before it expires
+class AppInstallationCredential(GitHubCredential):
+    def __init__(self, app_id, private_key, installation_id, owner):
+        super().__init__(f"app installation {owner}", owner=owner)
+        self.app_id = app_id
+        self.private_key = private_key
+        self.installation_id = installation_id
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def authorization(self):
+        with self.lock:
+            if time.time() > self.expires_at - 5 * 60:
+                response = httpx.post(f"{github_url}/app/installations/{self.installation_id}/access_tokens",
+                                      headers=github_app_headers(self.app_id, self.private_key), timeout=http_timeout())
+                response.raise_for_status()
+                installation_token = response.json()
+                self.token = installation_token["token"]
+                self.expires_at = calendar.timegm(time.strptime(installation_token["expires_at"], "%Y-%m-%dT%H:%M:%SZ"))
+        return super().authorization()
+
+# Headers authenticating as the GitHub App itself (a 10 minute RS256 JWT)
+def github_app_headers(app_id, private_key):
+    import jwt  # only needed for GitHub App credentials
+
+    now = int(time.time())
+    app_jwt = jwt.encode({"iat": now - 60, "exp": now + 9 * 60, "iss": str(app_id)}, private_key, algorithm="RS256")
+    return {"Authorization": f"Bearer {app_jwt}", "Accept": "application/vnd.github+json", "X-GitHub-Api-Version": "2022-11-28"}
+
+# Every token in GITHUB_TOKEN/GITHUB_TOKENS, plus one credential per installation of the GitHub App
+def load_github_credentials():
+    credentials = []
+    tokens = [github_token] + (github_tokens or "").split(",")
+    for token in dict.fromkeys(token.strip() for token in tokens if token and token.strip()):
+        credentials.append(GitHubCredential(f"token {len(credentials) + 1}", token))
+
+    if github_app_id and github_app_key_file:
+        with open(github_app_key_file) as key_file:
+            private_key = key_file.read()
+        response = httpx.get(f"{github_url}/app/installations", params={"per_page": 100}, headers=github_app_headers(github_app_id, private_key), timeout=http_timeout())
+        response.raise_for_status()
+        for installation in response.json():
+            credentials.append(AppInstallationCredential(github_app_id, private_key, installation["id"], installation["account"]["login"].lower()))
+
+    if not credentials:
+        credentials.append(GitHubCredential("anonymous"))
+    event_log.log("info", "github credentials", credentials=[credential.name for credential in credentials])
+    return credentials
+
+# The credential with the most quota left among those that can read the owner's repos
+def choose_github_credential(owner):
+    candidates = [credential for credential in github_credentials if credential.owner is None or credential.owner == owner]
+    return max(candidates or github_credentials, key=lambda credential: credential.limiter.tokens)
+
+# GitHub transport: routes each request to a credential, waits on that credential's limiter, and
+# retries rate-limited requests, possibly with another credential
+class GitHubTransport(RateLimitedTransport):
+    def __init__(self, **kwargs):
+        super().__init__(None, "github", **kwargs)
+
+    # Each try goes out with the credential best placed to read the repo's owner right now
+    def prepare(self, request):
+        owner = request.extensions.get("github_owner")
+        path = request.url.path.strip("/").split("/")
+        if owner is None and len(path) > 1 and path[0] in ("repos", "orgs", "users"):
+            owner = path[1].lower()
+
+        credential = choose_github_credential(owner)
+        request.headers.pop("Authorization", None)
+        authorization = credential.authorization()
+        if authorization:
+            request.headers["Authorization"] = authorization
+        return credential.limiter
+
+# SnykClient whose requests share the Snyk rate limiter and have timeouts, a deadline and hedging
+# like RateLimitedTransport; 5xx retries still use SnykClient's tries/delay/backoff, connection
+# errors and timeouts are retried here the same way. The deadline is set once per get/post/put/delete
+# call, so it spans the tries SnykClient's retry_call makes as well as the ones made here.
+class RateLimitedSnykClient(snyk.SnykClient):
+    calls = threading.local()  # deadline of the get/post/put/delete call this thread is in; request() runs only inside one
+
+    # SnykClient's name method (get, post, ...) under a fresh deadline; get_rest_pages and the
+    # models call get() once per page, so every page has its own
+    def call(self, name, *args, **kwargs):
+        self.calls.deadline = time.monotonic() + request_deadline
+        try:
+            return getattr(super(), name)(*args, **kwargs)
+        finally:
+            self.calls.deadline = None
+
+    def get(self, *args, **kwargs):
+        return self.call("get", *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.call("post", *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self.call("put", *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.call("delete", *args, **kwargs)
+
+    def request(self, method, url, headers, params=None, json=None):
+        endpoint = endpoint_family("snyk", url)
+        if time.monotonic() >= self.calls.deadline:
+            # retry_call's next try after the deadline passed
+            raise requests.exceptions.Timeout(f"no response within the {request_deadline:.0f}s deadline")
+        rate_limited = connection_errors = 0
+        while True:
+            # waits for the rate limit don't count against the deadline
+            self.calls.deadline += snyk_limiter.acquire()
+            deadline = self.calls.deadline
+            responses = []
+
+            def send(*args, **kwargs):
+                kwargs["timeout"] = (connect_timeout, read_timeout)
+                try:
+                    responses.append(hedged_send("snyk", endpoint, method.__name__.upper(), lambda: method(*args, **kwargs), deadline, snyk_limiter))
+                except TimeoutError as e:
+                    raise requests.exceptions.Timeout(str(e))
+                return responses[-1]
+
+            started = time.monotonic()
+            try:
+                resp = super().request(send, url, headers, params, json)
+            except snyk.errors.SnykHTTPError:
+                # error responses: SnykClient's retry_call sends 5xx and 429s again, after the limiter has taken
+                # any Retry-After into account. Other 4xx (a deleted project's 404, a rejected 422) are answers:
+                # counted as calls only and handed back, so get/post raise them once instead of retrying
+                status_code = responses[-1].status_code if responses else "error"
+                metrics.record_call("snyk", endpoint, status_code, time.monotonic() - started)
+                if responses:
+                    snyk_limiter.update(responses[-1].headers, status_code)
+                if status_code != "error" and 400 <= status_code < 500 and status_code != 429:
+                    return responses[-1]
+                metrics.record_retry("snyk", endpoint, "rate limit" if status_code == 429 else "server error")
+                raise
+            except requests.RequestException:
+                metrics.record_call("snyk", endpoint, "error", time.monotonic() - started)
+                if connection_errors >= tries - 1 or time.monotonic() >= deadline:
+                    raise
+                metrics.record_retry("snyk", endpoint, "connection error")
+                time.sleep(min(delay * backoff ** connection_errors, max(deadline - time.monotonic(), 0)))
+                connection_errors += 1
+                continue
+            except Exception:
+                metrics.record_call("snyk", endpoint, "error", time.monotonic() - started)
+                raise
+            metrics.record_call("snyk", endpoint, resp.status_code, time.monotonic() - started)
+            if not snyk_limiter.update(resp.headers, resp.status_code) or rate_limited == rate_limit_retries:
+                return resp
+            rate_limited += 1
+            metrics.record_retry("snyk", endpoint, "rate limit")
+
+# A limiter per GitHub credential and one for Snyk, each holding this process's share of the quota
+def create_limiters(share=1.0):
+    for credential in github_credentials:
+        credential.limiter = RateLimiter(f"GitHub ({credential.name})", rate=5000 / 3600, burst=100, reserve=github_rate_reserve, share=share)
+    return RateLimiter("Snyk", rate=snyk_rate_limit / 60, burst=snyk_rate_limit / 60, share=share)
+
+def github_rate_limit_wait():
+    return sum(credential.limiter.slept for credential in github_credentials)
+
+github_credentials = [GitHubCredential("anonymous")]  # replaced by load_github_credentials() at startup
+snyk_limiter = create_limiters()
+
+repo_index = RepoIndex()
+target_urls = {}  # Snyk target id -> target URL, so each target is fetched at most once per run
+pipeline_errors = []
+pipeline_stop = threading.Event()  # set once a stage fails, so the stages feeding it stop instead of blocking on a full queue
+run_stats = Counter()  # Totals reported at the end of the run
+project_errors = []  # (org id, project id, project name, error) for every failed project write
+
+journal = None  # Append handle on journal_file while the run is going
+journal_lock = threading.Lock()
+completed_orgs = set()  # Org ids finished by an interrupted run, from the journal
+journal_repo_keys = set()  # Repos whose status the journal already holds
+journal_writes = {}  # Project id -> [criticality, tags] already written according to the journal
+journal_deactivated = set()  # Project ids already deactivated according to the journal
+
+org_inventory = {}  # Org id -> {"org", "listed_at", "projects": [(project, target URL)]}, for webhook and daemon modes
+project_inventory = {}  # Repo key -> [(org, project)] of the Snyk projects on that repo
+projects_by_id = {}  # Project id -> (org, project, target URL)
+webhook_events = queue.Queue()  # (event name, payload) received and not yet handled
+
+inventory_db = None  # Connection to inventory_db_file while the run is going
+inventory_db_lock = threading.Lock()
+
+snyk_write_client = None  # Pooled client shared by all apply workers, see get_snyk_write_client
+snyk_write_client_lock = threading.Lock()
+github_client = None  # Pooled client and thread pool shared by all GitHub lookups of the run, see get_github_client
+github_executor = None
+github_client_lock = threading.Lock()
+github_org_targets = Counter()  # GitHub org -> targets seen in it so far, for the org sweep threshold
+swept_github_orgs = {}  # GitHub org -> {repo name: status} of the orgs swept this run (None if the sweep failed)
+
+github_cache = {}
+github_cache_lock = threading.Lock()
 
 def search_json(json_obj, search_string):
     if isinstance(json_obj, dict):
@@ -55,7 +1069,7 @@ def get_org_projects():
     #open_source_types = ['apk','cocoapods', 'composer', 'cpp', 'deb', 'golang', 'gradle', 'maven', 'npm', 'nuget', 'pip', 'pipenv', 'poetry', 'rubygems', 'sbt', 'swift', 'yarn']
     #iac_types = ['cloudformationconfig', 'armconfig', 'dockerfile', 'helm', 'k8sconfig', 'terraformconfig']
 
-    client = snyk.SnykClient(token, tries=tries, delay=delay, backoff=backoff, url=snyk_url)  # Context switch the client to model-based
+    client = RateLimitedSnykClient(token, tries=tries, delay=delay, backoff=backoff, url=snyk_url)  # Context switch the client to model-based
     print("getting orgs")
     
     organizations = client.organizations.all()
@@ -67,40 +1081,211 @@ def get_org_projects():
 
         print("geting repos per project")
         for project in projects:
-            if project.remoteRepoUrl not in all_remote_repo_urls:
+            if project.remoteRepoUrl is not None and repo_index.add(project.remoteRepoUrl):
                 print("getting remote repo for project: " + project.name)
-                all_remote_repo_urls.append(project.remoteRepoUrl)
                 get_scm_repo_status(project.remoteRepoUrl)
 
-def get_org_projects_rest():
+# Same paging as SnykClient.get_rest_pages, but one page at a time so callers can stream
+def iter_rest_pages(rest_client, path, params=None):
+    page_data = rest_client.get(path, params or {}).json()
+    yield page_data.get("data", [])
+
+    while page_data.get("links", {}).get("next"):
+        if page_data["links"]["next"] == page_data["links"].get("self"):
+            break
+        page_data = rest_client.get(page_data["links"]["next"], {}, exclude_version=True, exclude_params=True).json()
+        if not page_data.get("data"):
+            break
+        yield page_data["data"]
+
+def iter_rest_items(rest_client, path, params=None):
+    for page in iter_rest_pages(rest_client, path, params):
+        yield from page
+
+# Target URL of a project, from the target expanded into the project listing when present,
+# otherwise from the target itself (fetched once per target and cached)
+def get_project_target_url(rest_client, org, project):
+    target = project["relationships"]["target"]["data"]
+    if target["id"] not in target_urls:
+        if "attributes" in target:
+            target_urls[target["id"]] = target["attributes"].get("url")
+        else:
+            event_log.log("debug", "fetching target", org=org["id"], target=target["id"])
+            target = rest_client.get(f"/orgs/{org['id']}/targets/{target['id']}").json()["data"]
+            target_urls[target["id"]] = target["attributes"].get("url")
+    return target_urls[target["id"]]
+
+# Orgs are spread over machines (--shard i/N) and then over processes (--processes) by a stable
+# hash of the org id, so every run splits a group the same way
+def in_shard(org_id):
+    org_hash = zlib.crc32(org_id.encode())
+    return org_hash % shard_count == shard_index and (org_hash // shard_count) % shard_processes == shard_process
+
+# Per-process variant of a state file, so worker processes never write the same file
+def shard_path(path):
+    if path is None or shard_processes == 1:
+        return path
+    return f"{path}.{shard_process + 1}-of-{shard_processes}"
+
+# Pages of an org's projects as (project, target URL) pairs
+def list_org_projects(rest_client, org):
+    for projects in iter_rest_pages(rest_client, f"/orgs/{org['id']}/projects", {"expand": "target"}):
+        yield [(project, get_project_target_url(rest_client, org, project)) for project in projects]
+
+# Listing stage: streams each page of an org's projects, with the target URLs expanded inline,
+# to the resolve stage; the page's new repo URLs go ahead of its projects
+def get_org_projects_rest(listed):
     #open_source_types = ['apk','cocoapods', 'composer', 'cpp', 'deb', 'golang', 'gradle', 'maven', 'npm', 'nuget', 'pip', 'pipenv', 'poetry', 'rubygems', 'sbt', 'swift', 'yarn']
     #iac_types = ['cloudformationconfig', 'armconfig', 'dockerfile', 'helm', 'k8sconfig', 'terraformconfig']
 
     #with create_client(token=token, tenant="us") as client:
-    rest_client = snyk.SnykClient(token, tries=tries, delay=delay, backoff=backoff, version=apiVersion, url=snyk_url)  # Context switch the client to model-based
-    print("getting orgs")
+    rest_client = RateLimitedSnykClient(token, tries=tries, delay=delay, backoff=backoff, version=apiVersion, url=snyk_url)  # Context switch the client to model-based
+    event_log.log("info", "listing orgs")
 
-    organizations = rest_client.get_rest_pages(f"/orgs/")
-    print("orgs retrieved: " +  str(organizations) )
+    for org in iter_rest_items(rest_client, f"/orgs/"):
+        if not in_shard(org["id"]):
+            continue
+        event_log.log("info", "org", org=org["id"], name=org["attributes"].get("name"))
+        event_log.log("debug", "org payload", org=org)
+        if org["id"] in completed_orgs:
+            event_log.log("info", "org skipped", org=org["id"], reason="completed by the interrupted run")
+            continue
 
-    for org in organizations:
-        #print("getting projects for org: " + str(org))    
-        
-        targets = rest_client.get_rest_pages(f"/orgs/{org['id']}/targets")
-        all_snyk_targets.append(targets)
+        now = time.time()
+        stored = stored_org_projects(org, now)
+        if stored is not None:
+            event_log.log("info", "org skipped", org=org["id"], reason="served from the inventory")
+        listing = []
+        for project_urls in [stored] if stored is not None else list_org_projects(rest_client, org):
+            listing.extend(project_urls)
+            new_repo_urls = []
+            for project, targetUrl in project_urls:
+                event_log.log("debug", "project", org=org["id"], target=targetUrl, project=project)
+                if targetUrl is not None and repo_index.add(targetUrl):
+                    new_repo_urls.append(targetUrl)
+
+            if new_repo_urls:
+                pipeline_put(listed, ("repos", new_repo_urls))
+            for project, targetUrl in project_urls:
+                pipeline_put(listed, ("project", org, project, targetUrl))
 
-        #print("geting repos for projects: " + str(projects))
-        for target in targets:
-            print("project: " + str(target))
-            targetUrl = target["attributes"]["url"]
+        if stored is None:
+            store_org_projects(org, listing, now)
+        pipeline_put(listed, ("org done", org))
 
-            if targetUrl not in all_remote_repo_urls:
-                all_remote_repo_urls.append(targetUrl)
-                get_scm_repo_status(targetUrl)
+# Resolve stage: collects new repo URLs until it has github_graphql_batch of them, lookup_batch_window
+# has passed or a queue's worth of items is held back, looks them up together (full GraphQL queries,
+# org sweeps that see more of each org), then passes on the projects once every repo listed ahead
+# of them has a status
+def resolve_repo_statuses(listed, resolved):
+    finished = False
+    while not finished:
+        batch = [pipeline_get(listed)]
+        flush_at = time.monotonic() + lookup_batch_window
+        new_repos = len(batch[0][1]) if batch[0] is not None and batch[0][0] == "repos" else 0
+        while batch[-1] is not None and new_repos < github_graphql_batch and len(batch) < pipeline_queue_size:
+            wait = flush_at - time.monotonic()
+            if wait <= 0 or pipeline_stop.is_set():
+                break
+            try:
+                item = listed.get(timeout=min(wait, 0.1))
+            except queue.Empty:
+                continue
+            batch.append(item)
+            if item is not None and item[0] == "repos":
+                new_repos += len(item[1])
+
+        repo_urls = []
+        for item in batch:
+            if item is None:
+                finished = True
+            elif item[0] == "repos":
+                repo_urls.extend(item[1])
+
+        # look the repos up concurrently rather than one connection per target
+        get_scm_repo_statuses(repo_urls)
+        repo_index.classify()
+
+        for item in batch:
+            if item is not None and item[0] != "repos":
+                pipeline_put(resolved, item)
+
+def in_phase(phase, function, *args):
+    with metrics.timed_phase(phase):
+        return function(*args)
+
+class PipelineStopped(Exception):
+    pass
+
+# Put an item on a pipeline queue, waiting while it is full unless the pipeline stops
+def pipeline_put(pipeline_queue, item):
+    while True:
+        if pipeline_stop.is_set():
+            raise PipelineStopped()
+        try:
+            pipeline_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+# Next item of a pipeline queue; None, like the end marker, once the pipeline stops
+def pipeline_get(pipeline_queue):
+    while not pipeline_stop.is_set():
+        try:
+            return pipeline_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+# Run a pipeline stage on its own thread; its downstream queue gets the end marker, or
+# sees the pipeline stop
+def start_stage(phase, stage, *queues):
+    def run():
+        try:
+            with metrics.timed_phase(phase):
+                stage(*queues)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            pipeline_errors.append(e)
+            pipeline_stop.set()
+        finally:
+            try:
+                pipeline_put(queues[-1], None)
+            except PipelineStopped:
+                pass
+
+    thread = threading.Thread(target=run, name=stage.__name__, daemon=True)
+    thread.start()
+    return thread
+
+# One pass over the group: list -> resolve repo status -> apply, connected by bounded queues
+# so tagging starts while listing is still running and memory stays flat
+def run_pipeline(last_stage=None):
+    last_stage = last_stage or apply_snyk_org_tags_rest
+    listed = queue.Queue(maxsize=pipeline_queue_size)
+    resolved = queue.Queue(maxsize=pipeline_queue_size)
+
+    stages = [
+        start_stage("list", get_org_projects_rest, listed),
+        start_stage("lookup", resolve_repo_statuses, listed, resolved),
+    ]
+    try:
+        with metrics.timed_phase("plan" if last_stage == plan_snyk_org_tags_rest else "decide"):
+            last_stage(resolved)
+    except BaseException:
+        pipeline_stop.set()
+        raise
+
+    # a failed stage stopped the ones upstream of it, so none of them is left blocked
+    for stage in stages:
+        stage.join()
+    if pipeline_errors:
+        raise pipeline_errors[0]
 
 def apply_snyk_org_tags():
     #with create_client(token=token, tenant="us") as client:
-    client = snyk.SnykClient(token, tries=tries, delay=delay, backoff=backoff, url=snyk_url)
+    client = RateLimitedSnykClient(token, tries=tries, delay=delay, backoff=backoff, url=snyk_url)
     organizations = client.organizations.all()
 
     for org in organizations:
@@ -111,7 +1296,7 @@ def apply_snyk_org_tags():
         for project in projects:
             #print("\nupdate project tags: " + project.name)
             delete_tags(project)
-            if project.remoteRepoUrl in remote_repos_stale:
+            if project.remoteRepoUrl is not None and repo_index.is_stale(project.remoteRepoUrl):
                 #delete_tag(project, "active_repo", "true")
                 add_tag(project, "active_repo", "false")
                 print("project tagged inactive \n")
@@ -123,47 +1308,368 @@ def apply_snyk_org_tags():
                 set_project_criticality(org, project, "high")
             print("\n")
 
-def apply_snyk_org_tags_rest():
-    #with create_client(token=token, tenant="us") as client:
-    rest_client = snyk.SnykClient(token, tries=tries, delay=delay, backoff=backoff, version=apiVersion, url=snyk_url)
-    v1_client = snyk.SnykClient(token, tries=tries, delay=delay, backoff=backoff, url=v1_snyk_url)   # Context switch the client to model-based
-    print("getting orgs")
+# Desired criticality and tags of a project, and whether to deactivate it. tags is None when the
+# project already has them (per the listing or the journal of an interrupted run).
+# Logs one compact decision record per project.
+def decide_project_change(org, project, targetUrl):
+    run_stats["projects"] += 1
+    if targetUrl is not None and repo_index.is_stale(targetUrl):
+        criticality = "low"
+        tags = desired_project_tags(project, "false")
+    else:
+        criticality = "high"
+        tags = desired_project_tags(project, "true")
 
-    organizations = rest_client.get_rest_pages(f"/orgs/")
-    #organizations = client.organizations.all()
+    skipped = None
+    if journal_writes.get(project["id"]) == [criticality, tags]:
+        skipped = "applied by the interrupted run"
+    elif project_needs_update(project, criticality, tags):
+        run_stats["project writes"] += 1
+    else:
+        skipped = "already applied"
+    if skipped:
+        run_stats["project writes skipped"] += 1
+        tags = None
 
-    for org in organizations:
-        projects = rest_client.get_rest_pages(f"/orgs/{org['id']}/projects")
-        #projects = org.projects.all()
+    deactivate = targetUrl is not None and repo_index.is_archived(targetUrl) and project["id"] not in journal_deactivated
+    if deactivate and project["attributes"].get("status") == "inactive":
+        run_stats["already inactive"] += 1
+        deactivate = False
+    event_log.log("info", "decision", org=org["id"], project=project["id"], name=project["attributes"]["name"],
+                  criticality=criticality, write=tags is not None, skipped=skipped, deactivate=deactivate)
+    return criticality, tags, deactivate
 
-        #print("PROJECTS FOUND: " + str(projects))
-        
-        for project in projects:
-            #print("\nupdate project tags: " + str(project))
+# snyk_apply_workers workers, each draining its own lane; every org maps to one lane,
+# so an org's writes stay in order. Deactivations go on to the deactivation stage.
+def start_apply_lanes():
+    deactivations = Deactivations()
+    lanes = [queue.Queue(maxsize=pipeline_queue_size) for _ in range(snyk_apply_workers)]
+    workers = [threading.Thread(target=in_phase, args=("apply", apply_project_writes, lane, deactivations), daemon=True) for lane in lanes]
+    for worker in workers:
+        worker.start()
+    return lanes, workers, deactivations
 
-            #get remoteRepoUrl from target
-            targetId = project["relationships"]["target"]["data"]["id"]
+def org_lane(lanes, org_id):
+    return lanes[zlib.crc32(org_id.encode()) % len(lanes)]
 
-            print("found related targetId: " + str(targetId))
-            target = rest_client.get(f"/orgs/{org['id']}/targets/{targetId}").json()
-            print("found related target: " + str(target))
+def stop_apply_lanes(lanes, workers, deactivations):
+    for lane in lanes:
+        lane.put(None)
+    for worker in workers:
+        worker.join()
+    deactivations.close()
 
-            targetUrl = target["data"]["attributes"]["url"]
+'''
+Bulk deactivation of the projects on archived repos, a stage of its own next to the apply lanes:
+deactivations are posted as the lanes hand them over, snyk_deactivate_workers at a time. Once
+an org's lane is done, its deactivations are checked by listing those projects by id. Only
+verified deactivations, and orgs whose writes and deactivations all went through, are
+journaled, so a resumed run retries the rest.
+'''
+class Deactivations:
+    def __init__(self):
+        #with create_client(token=token, tenant="us") as client:
+        self.v1_client = RateLimitedSnykClient(token, tries=tries, delay=delay, backoff=backoff, url=v1_snyk_url)   # Context switch the client to model-based
+        self.rest_client = RateLimitedSnykClient(token, tries=tries, delay=delay, backoff=backoff, version=apiVersion, url=snyk_url)
+        self.posts = ThreadPoolExecutor(max_workers=snyk_deactivate_workers, initializer=metrics.set_phase, initargs=("deactivate",))
+        self.checks = ThreadPoolExecutor(max_workers=1, initializer=metrics.set_phase, initargs=("deactivate",))
+        self.pending = {}  # org id -> (org, [(project, future of its deactivation)])
+        self.verifications = []
+        self.lock = threading.Lock()
+
+    def add(self, org, project):
+        future = self.posts.submit(self.deactivate, org, project)
+        with self.lock:
+            self.pending.setdefault(org["id"], (org, []))[1].append((project, future))
+
+    def deactivate(self, org, project):
+        event_log.log("debug", "deactivating", org=org["id"], project=project["id"])
+        self.v1_client.post(f"/org/{org['id']}/project/{project['id']}/deactivate", body={}, headers={"Content-Type": "application/vnd.api+json"})
+
+    # The org's lane is done; org_complete is False when one of its project writes failed
+    def org_done(self, org, org_complete):
+        with self.lock:
+            _, deactivations = self.pending.pop(org["id"], (org, []))
+            self.verifications.append(self.checks.submit(self.verify, org, deactivations, org_complete))
 
-            if targetUrl in remote_repos_stale:
-                tags = [{"key": "active_repo", "value": "false"}]
-                with create_client(token=token, tenant="us") as client:
-                    apply_criticality_to_project(client, org["id"], project["id"], "low", project["attributes"]["name"], tags)
+    def verify(self, org, deactivations, org_complete):
+        posted = []
+        for project, future in deactivations:
+            try:
+                future.result()
+                posted.append(project)
+            except Exception as e:
+                project_errors.append((org["id"], project["id"], project["attributes"]["name"], f"deactivation failed: {e!r}"))
+                org_complete = False
+
+        statuses = {}
+        try:
+            for i in range(0, len(posted), deactivation_verify_batch):
+                ids = ",".join(project["id"] for project in posted[i:i + deactivation_verify_batch])
+                for listed in iter_rest_items(self.rest_client, f"/orgs/{org['id']}/projects", {"ids": ids, "limit": deactivation_verify_batch}):
+                    statuses[listed["id"]] = listed["attributes"].get("status")
+        except Exception as e:
+            event_log.log("warning", "deactivation check failed", org=org["id"], error=repr(e))
+
+        verified = 0
+        for project in posted:
+            if statuses.get(project["id"]) == "inactive":
+                project["attributes"]["status"] = "inactive"
+                store_project(org["id"], project)
+                journal_record(type="deactivate", project_id=project["id"])
+                verified += 1
             else:
-                tags = [{"key": "active_repo", "value": "true"}]
-                with create_client(token=token, tenant="us") as client:
-                    apply_criticality_to_project(client, org["id"], project["id"], "high", project["attributes"]["name"], tags)
+                project_errors.append((org["id"], project["id"], project["attributes"]["name"],
+                                       f"still {statuses.get(project['id'], 'unchecked')} after deactivation"))
+                org_complete = False
+        run_stats["deactivations"] += verified
+        if deactivations:
+            event_log.log("info", "deactivations verified", org=org["id"], verified=verified, failed=len(deactivations) - verified)
+
+        if org_complete:
+            journal_record(type="org", org_id=org["id"])
+
+    # Check what is still pending (apply mode hands over no org ends) and wait for everything
+    def close(self):
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        with self.lock:
+            for org, deactivations in pending:
+                self.verifications.append(self.checks.submit(self.verify, org, deactivations, False))
+        for verification in self.verifications:
+            verification.result()
+        self.checks.shutdown()
+        self.posts.shutdown()
+
+# Apply stage: decides each project's state as it arrives from the resolve stage and hands the
+# writes to the apply workers
+def apply_snyk_org_tags_rest(resolved):
+    lanes, workers, deactivations = start_apply_lanes()
+
+    for item in iter(lambda: pipeline_get(resolved), None):
+        if item[0] == "org done":
+            # queued behind the org's writes, so its lane sees it once they are all done
+            org_lane(lanes, item[1]["id"]).put(item)
+            continue
+
+        _, org, project, targetUrl = item
+        #print("\nupdate project tags: " + str(project))
+        criticality, tags, deactivate = decide_project_change(org, project, targetUrl)
+        if tags is not None or deactivate:
+            org_lane(lanes, org["id"]).put(("project", org, project, criticality, tags, deactivate))
+
+    stop_apply_lanes(lanes, workers, deactivations)
+
+# Plan stage: same decisions as the apply stage, written to plan_file as one JSON line per
+# project that needs a change instead of being applied
+def plan_snyk_org_tags_rest(resolved):
+    with open(plan_file, "w") as plan:
+        for item in iter(lambda: pipeline_get(resolved), None):
+            if item[0] == "org done":
+                continue
+
+            _, org, project, targetUrl = item
+            criticality, tags, deactivate = decide_project_change(org, project, targetUrl)
+            if tags is not None or deactivate:
+                plan.write(json.dumps({
+                    "org_id": org["id"],
+                    "project_id": project["id"],
+                    "name": project["attributes"]["name"],
+                    "criticality": criticality,
+                    "tags": tags,
+                    "deactivate": deactivate,
+                    "current_criticality": project["attributes"].get("business_criticality"),
+                    "current_tags": project["attributes"].get("tags"),
+                }) + "\n")
+                run_stats["planned changes"] += 1
+    event_log.log("info", "plan written", path=plan_file, changes=run_stats["planned changes"])
+
+# Execute a plan written by plan mode; nothing is read from Snyk or GitHub
+def apply_plan(path):
+    lanes, workers, deactivations = start_apply_lanes()
+    with open(path) as plan:
+        for line in plan:
+            change = json.loads(line)
+            if not in_shard(change["org_id"]):
+                continue
+            org = {"id": change["org_id"]}
+            project = {"id": change["project_id"], "attributes": {"name": change["name"]}}
+            # skip what the interrupted apply already did, as decide_project_change does
+            tags = change["tags"]
+            if tags is not None and journal_writes.get(project["id"]) == [change["criticality"], tags]:
+                run_stats["project writes skipped"] += 1
+                tags = None
+            elif tags is not None:
+                run_stats["project writes"] += 1
+            deactivate = change["deactivate"] and project["id"] not in journal_deactivated
+            if tags is not None or deactivate:
+                org_lane(lanes, org["id"]).put(("project", org, project, change["criticality"], tags, deactivate))
+    stop_apply_lanes(lanes, workers, deactivations)
+
+# Apply worker: runs one lane's writes in order over the shared pooled client and hands the
+# deactivations, and each org once all of its writes were sent, to the deactivation stage
+def apply_project_writes(lane, deactivations):
+    client = get_snyk_write_client()
+    failed_orgs = set()
+    for item in iter(lane.get, None):
+        if item[0] == "org done":
+            deactivations.org_done(item[1], item[1]["id"] not in failed_orgs)
+            continue
+
+        _, org, project, criticality, tags, deactivate = item
+        project_name = project["attributes"]["name"]
+        try:
+            if tags is not None:
+                req = apply_criticality_to_project(client, org["id"], project["id"], criticality, project_name, tags)
+                if req.status_code in (200, 422):
+                    project["attributes"].update(business_criticality=[criticality], tags=tags)
+                    store_project(org["id"], project)
+                    journal_record(type="write", project_id=project["id"], criticality=criticality, tags=tags)
+                else:
+                    project_errors.append((org["id"], project["id"], project_name, f"PATCH returned {req.status_code}"))
+                    failed_orgs.add(org["id"])
 
-            if targetUrl in remote_repos_archived:
-                print(f"hitting url: /orgs/{org['id']}/projects/{project['id']}/deactivate")
-                v1_client.post(f"/org/{org['id']}/project/{project['id']}/deactivate", body={}, headers={"Content-Type": "application/vnd.api+json"}).json()
+            if deactivate:
+                deactivations.add(org, project)
+        except Exception as e:
+            project_errors.append((org["id"], project["id"], project_name, repr(e)))
+            failed_orgs.add(org["id"])
 
-            print("\n")          
+# Append one checkpoint to the journal; flushed right away so a crash loses at most this line
+def journal_record(**record):
+    if journal is not None:
+        with journal_lock:
+            journal.write(json.dumps(record) + "\n")
+            journal.flush()
+
+inventory_schema = '''
+CREATE TABLE IF NOT EXISTS orgs (id TEXT PRIMARY KEY, name TEXT, slug TEXT, updated_at TEXT, listed_at REAL);
+CREATE TABLE IF NOT EXISTS targets (id TEXT PRIMARY KEY, url TEXT, repo_key TEXT);
+CREATE TABLE IF NOT EXISTS projects (id TEXT PRIMARY KEY, org_id TEXT NOT NULL, target_id TEXT, name TEXT, type TEXT,
+    status TEXT, criticality TEXT, tags TEXT, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS repo_status (key TEXT PRIMARY KEY, url TEXT, repo_id INTEGER, pushed_at TEXT, archived INTEGER,
+    stale INTEGER, checked_at REAL, due_at REAL);
+CREATE INDEX IF NOT EXISTS targets_url ON targets (url);
+CREATE INDEX IF NOT EXISTS targets_repo_key ON targets (repo_key);
+CREATE INDEX IF NOT EXISTS projects_org_id ON projects (org_id);
+CREATE INDEX IF NOT EXISTS projects_target_id ON projects (target_id);
+CREATE VIEW IF NOT EXISTS projects_on_archived_repos AS
+    SELECT orgs.name AS org, projects.id AS project_id, projects.name AS project, projects.status, targets.url, repo_status.pushed_at
+    FROM projects JOIN targets ON targets.id = projects.target_id JOIN repo_status ON repo_status.key = targets.repo_key
+    JOIN orgs ON orgs.id = projects.org_id
+    WHERE repo_status.archived;
+'''
+
+# Open (or create) the inventory database and warm the target URL and repo status lookups from it.
+# WAL lets other tools query it while a run is writing, and worker processes share it.
+def open_inventory_db(path):
+    global inventory_db
+    inventory_db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    inventory_db.execute("PRAGMA journal_mode=WAL")
+    inventory_db.execute("PRAGMA synchronous=NORMAL")
+    inventory_db.executescript(inventory_schema)
+
+    target_urls.update(inventory_db.execute("SELECT id, url FROM targets"))
+    for key, url, repo_id, pushed_at, archived, stale, checked_at, due_at in inventory_db.execute("SELECT * FROM repo_status"):
+        repo_index.repos.setdefault(key, {"url": url, "repo_id": repo_id, "pushed_at": pushed_at, "archived": bool(archived),
+                                          "stale": bool(stale), "checked_at": checked_at, "due_at": due_at})
+        if repo_id is not None:
+            repo_index.keys_by_id.setdefault(repo_id, key)
+    event_log.log("info", "inventory db opened", path=path, targets=len(target_urls), repos=len(repo_index))
+
+# An org's (project, target URL) pairs from the inventory when --trust-inventory is set and the org
+# was listed less than daemon_full_refresh ago, otherwise None. Snyk's org updated_at does not move
+# when projects are added, removed or retargeted, so nothing tells a stored listing is still current.
+def stored_org_projects(org, now):
+    if inventory_db is None or not trust_inventory:
+        return None
+    with inventory_db_lock:
+        row = inventory_db.execute("SELECT listed_at FROM orgs WHERE id = ?", (org["id"],)).fetchone()
+        if row is None or now - row[0] >= daemon_full_refresh:
+            return None
+        rows = inventory_db.execute("SELECT projects.data, targets.url FROM projects LEFT JOIN targets ON targets.id = projects.target_id "
+                                    "WHERE projects.org_id = ?", (org["id"],)).fetchall()
+    return [(json.loads(data), url) for data, url in rows]
+
+def project_row(org_id, project):
+    attributes = project["attributes"]
+    target_id = project.get("relationships", {}).get("target", {}).get("data", {}).get("id")
+    return (project["id"], org_id, target_id, attributes.get("name"), attributes.get("type"), attributes.get("status"),
+            (attributes.get("business_criticality") or [None])[0], json.dumps(attributes.get("tags") or []), json.dumps(project))
+
+# Replace an org's projects and targets in the inventory with a fresh listing
+def store_org_projects(org, projects, now):
+    if inventory_db is None:
+        return
+    attributes = org.get("attributes", {})
+    project_rows = [project_row(org["id"], project) for project, _ in projects]
+    targets = {row[2]: (row[2], targetUrl, targetUrl and repo_index.key(targetUrl))
+               for row, (_, targetUrl) in zip(project_rows, projects) if row[2] is not None}
+    with inventory_db_lock, inventory_db:
+        inventory_db.execute("INSERT OR REPLACE INTO orgs VALUES (?, ?, ?, ?, ?)",
+                             (org["id"], attributes.get("name"), attributes.get("slug"), attributes.get("updated_at"), now))
+        inventory_db.execute("DELETE FROM projects WHERE org_id = ?", (org["id"],))
+        inventory_db.executemany("INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", project_rows)
+        inventory_db.executemany("INSERT OR REPLACE INTO targets VALUES (?, ?, ?)", targets.values())
+
+# Keep a project's row in line with a write just sent for it
+def store_project(org_id, project):
+    if inventory_db is None:
+        return
+    with inventory_db_lock, inventory_db:
+        inventory_db.execute("INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", project_row(org_id, project))
+
+def store_repo_statuses():
+    if inventory_db is None:
+        return
+    rows = [(key, entry.get("url"), entry.get("repo_id"), entry.get("pushed_at"), entry.get("archived"), entry.get("stale"),
+             entry.get("checked_at"), entry.get("due_at")) for key, entry in list(repo_index.repos.items()) if "due_at" in entry]
+    with inventory_db_lock, inventory_db:
+        inventory_db.executemany("INSERT OR REPLACE INTO repo_status VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+# Replay the journal of an interrupted run: finished orgs, repo statuses and applied writes
+def load_journal(path):
+    complete = 0  # bytes up to the end of the last complete record
+    with open(path, "rb") as journal_lines:
+        for line in journal_lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break  # the line the crash cut short
+            complete += len(line)
+
+            if record["type"] == "org":
+                completed_orgs.add(record["org_id"])
+            elif record["type"] == "repo":
+                repo_index.record_status(record["url"], record["pushed_at"], record["archived"], record["repo_id"], record["full_name"])
+                journal_repo_keys.add(repo_index.key(record["url"]))
+            elif record["type"] == "write":
+                journal_writes[record["project_id"]] = [record["criticality"], record["tags"]]
+            elif record["type"] == "deactivate":
+                journal_deactivated.add(record["project_id"])
+
+    repo_index.classify()
+
+    # drop a cut-short last line so new records start on a line of their own
+    with open(path, "r+b") as journal_lines:
+        journal_lines.truncate(complete)
+
+    event_log.log("info", "resuming from journal", path=path, orgs=len(completed_orgs), repos=len(journal_repo_keys),
+                  writes=len(journal_writes), deactivations=len(journal_deactivated))
+
+# The project's current tags with active_repo set to the given value
+def desired_project_tags(project, active_repo):
+    tags = [tag for tag in project["attributes"].get("tags") or [] if tag["key"] != "active_repo"]
+    return tags + [{"key": "active_repo", "value": active_repo}]
+
+# Compare against the state the project listing already returned, so unchanged projects need no PATCH
+def project_needs_update(project, criticality, tags):
+    attributes = project["attributes"]
+    if attributes.get("business_criticality") != [criticality] or attributes.get("tags") is None:
+        return True
+    current = {(tag["key"], tag["value"]) for tag in attributes["tags"]}
+    return current != {(tag["key"], tag["value"]) for tag in tags}
 
 #remove stale tags
 def delete_tags(project):
@@ -181,12 +1687,19 @@ def add_tag(project, key, value):
             project.tags.add(key, value)
 
 def set_project_criticality(org, project, criticality):
-    with create_client(token=token, tenant="us") as client:
-        apply_criticality_to_project(client, org.id, project.id, criticality, project.name)
+    apply_criticality_to_project(get_snyk_write_client(), org.id, project.id, criticality, project.name)
+
+# One connection-pooled client for all project writes, created on first use
+def get_snyk_write_client() -> httpx.Client:
+    global snyk_write_client
+    with snyk_write_client_lock:
+        if snyk_write_client is None:
+            snyk_write_client = create_client(token=token, tenant="us", max_connections=snyk_apply_workers)
+    return snyk_write_client
 
 # Reach to the API and generate tokens
-def create_client(token: str, tenant: str) -> httpx.Client:
-    base_url = (
+def create_client(token: str, tenant: str, max_connections: int = None) -> httpx.Client:
+    base_url = os.getenv('SNYK_URL') or (
         f"https://api.{tenant}.snyk.io/rest"
         if tenant in ["eu", "au", "us"]
         else "https://api.snyk.io/rest"
@@ -196,7 +1709,9 @@ def create_client(token: str, tenant: str) -> httpx.Client:
         "Authorization": f"token {token}",
         "Content-Type": 'application/vnd.api+json'
     }
-    return httpx.Client(base_url=base_url, headers=headers)
+    # room for a hedged try next to every connection
+    limits = httpx.Limits(max_connections=max_connections and 2 * max_connections, max_keepalive_connections=max_connections)
+    return httpx.Client(base_url=base_url, headers=headers, timeout=http_timeout(), transport=RateLimitedTransport(snyk_limiter, "snyk", limits=limits))
 
 def apply_criticality_to_project(
     client: httpx.Client,
@@ -204,7 +1719,7 @@ def apply_criticality_to_project(
     project_id: str,
     criticality: str,
     project_name: str,
-    tags: list
+    tags: list = None
 ) :#-> tuple:
     attribute_data = {
         "data": {
@@ -216,65 +1731,736 @@ def apply_criticality_to_project(
             "relationships": {}
         }
     }
+    if tags is not None:
+        attribute_data["data"]["attributes"]["tags"] = tags
     
     params = {'version': apiVersion}
-    req = client.patch(f"orgs/{org_id}/projects/{project_id}", json=attribute_data, params=params, timeout=None)
+    req = client.patch(f"orgs/{org_id}/projects/{project_id}", json=attribute_data, params=params)
     #print("REQUEST text: " + str(req.text))
 
-    if req.status_code == 200:
-        print(f"Successfully added {criticality} criticality to Project: {project_name}.")
-    elif req.status_code == 422:
-        print(f"{criticality} already applied for Project: {project_name}.")
-    elif req.status_code == 404:
-        print(f"Project not found, likely a READ-ONLY project. Project: {project_name}. attribute: {attribute_data}.")
+    if req.status_code in (200, 422):
+        # 422: the criticality was already applied
+        event_log.log("debug", "project written", org=org_id, project=project_id, status=req.status_code)
+    else:
+        # 404 is most likely a READ-ONLY project
+        event_log.log("warning", "project write failed", org=org_id, project=project_id, name=project_name, status=req.status_code)
+        event_log.log("debug", "project write payload", project=project_id, body=attribute_data, response=req.text)
+    return req
 
-def get_scm_repo_status(repo_path):
+def github_cache_key(repo_path):
+    return repo_index.key(repo_path)
+
+def load_github_cache(path):
+    if os.path.exists(path):
+        with open(path) as cache_file:
+            github_cache.update(json.load(cache_file))
+        event_log.log("info", "github cache loaded", path=path, repos=len(github_cache))
+
+def save_github_cache(path):
+    with github_cache_lock:
+        entries = sorted(github_cache.items(), key=lambda item: item[1]["fetched_at"], reverse=True)
+    entries = dict(entries[:github_cache_max_entries])
+
+    # write then rename so an interrupted run never leaves a truncated cache behind
+    with open(path + ".tmp", "w") as cache_file:
+        json.dump(entries, cache_file)
+    os.replace(path + ".tmp", path)
+
+# Keep only the fields the tagging reads; the ETag survives updates that don't carry one
+def cache_repo_status(repo_path, json_obj, etag=None):
+    key = github_cache_key(repo_path)
+    with github_cache_lock:
+        entry = github_cache.get(key, {})
+        github_cache[key] = {
+            "status": {"pushed_at": json_obj["pushed_at"], "archived": json_obj["archived"], "id": json_obj.get("id"), "full_name": json_obj.get("full_name")},
+            "etag": etag or entry.get("etag"),
+            "fetched_at": time.time(),
+        }
+
+# Record every repo whose cached status is still within the TTL, return the ones that need GitHub
+def record_cached_repo_statuses(repo_paths):
+    uncached = []
+    now = time.time()
+    for repo_path in repo_paths:
+        entry = github_cache.get(github_cache_key(repo_path))
+        if entry is not None and now - entry["fetched_at"] < github_cache_ttl:
+            record_scm_repo_status(repo_path, entry["status"], cached=True)
+        else:
+            uncached.append(repo_path)
+    event_log.log("info", "github cache", cached=len(repo_paths) - len(uncached), to_fetch=len(uncached))
+    return uncached
+
+# The run's GitHub client and lookup thread pool, github_workers wide, made on first use
+def get_github_client():
+    global github_client, github_executor
+    with github_client_lock:
+        if github_client is None:
+            github_client = create_github_client(github_workers)
+            github_executor = ThreadPoolExecutor(max_workers=github_workers, thread_name_prefix="lookup")
+    return github_client
+
+def close_github_client():
+    global github_client, github_executor
+    if github_client is not None:
+        github_executor.shutdown()
+        github_client.close()
+        github_client = github_executor = None
+
+# Run a GitHub lookup on the shared pool; its calls count towards the phase of the thread submitting it
+def submit_lookup(function, *args):
+    get_github_client()
+    phase = metrics.phase()
+    def run():
+        metrics.set_phase(phase)
+        return function(*args)
+    return github_executor.submit(run)
+
+# Pooled keep-alive client shared by all GitHub lookup workers
+def create_github_client(max_connections: int) -> httpx.Client:
     headers = {
         'Accept': 'application/vnd.github+json',
-        'Authorization': "Bearer " + github_token,
         'User-Agent' : 'python script', 
         'X-GitHub-Api-Version': '2022-11-28',
     }
+    # room for a hedged try next to every connection
+    limits = httpx.Limits(max_connections=2 * max_connections, max_keepalive_connections=max_connections)
+    return httpx.Client(base_url=github_url, headers=headers, timeout=http_timeout(), transport=GitHubTransport(limits=limits))
+
+def fetch_scm_repo_status(client, repo_path):
+    github_Org, repo_name = github_repo_name(repo_path)
+
+    # revalidate expired cache entries; a 304 doesn't count against the rate limit
+    headers = {}
+    entry = github_cache.get(github_cache_key(repo_path)) if github_cache_file else None
+    if entry is not None and entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+
+    response = client.get(f"/repos/{github_Org}/{repo_name}", headers=headers)
+    if response.status_code == 304:
+        # GitHub confirmed the entry, so record_scm_repo_status restarts its TTL
+        return entry["status"]
+
+    json_obj = response.json()
+    if github_cache_file and response.status_code == 200 and "ETag" in response.headers:
+        cache_repo_status(repo_path, json_obj, response.headers["ETag"])
+    return json_obj
+
+# cached is True for statuses served from github_cache, which must not restart their TTL
+def record_scm_repo_status(repo_path, json_obj, cached=False):
+    if 'status' in json_obj and json_obj['status'] == '404':
+        event_log.log("warning", "repo inaccessible", repo=repo_path, reason="unauthorized (404) for this key")
+    elif 'status' in json_obj and json_obj['status'] == '401':
+        event_log.log("error", "repo inaccessible", repo=repo_path, reason="bad credentials (401), invalid GitHub token")
+    elif json_obj.get('pushed_at') and 'archived' in json_obj:
+        pushed_at_date = json_obj['pushed_at']
+        event_log.log("debug", "repo status", repo=repo_path, pushed_at=pushed_at_date, archived=json_obj['archived'])
+        run_stats["repos looked up"] += 1
+
+        if github_cache_file and not cached:
+            cache_repo_status(repo_path, json_obj)
+
+        repo_index.record_status(repo_path, pushed_at_date, json_obj['archived'], json_obj.get('id'), json_obj.get('full_name'))
+        journal_record(type="repo", url=repo_path, pushed_at=pushed_at_date, archived=json_obj['archived'], repo_id=json_obj.get('id'), full_name=json_obj.get('full_name'))
+    else:
+        event_log.log("warning", "repo inaccessible", repo=repo_path, reason="unknown response")
+        event_log.log("debug", "repo response", repo=repo_path, response=json_obj)
 
-    print("\n")
+def get_scm_repo_status(repo_path):
     if repo_path is not None:
-        print("processing repo_path: " + repo_path)
-        github_Org, repo_name = repo_path.split("/")[-2:]
-
-        request_url = f"/repos/{github_Org}/{repo_name}"
-        conn = http.client.HTTPSConnection("api.github.com")
-        conn.request("GET", request_url, None, headers)
-        response = conn.getresponse()
-        response_data = response.read()
-        conn.close()
-
-        json_obj = json.loads(response_data.decode())
-
-        #print("\n\n\ngithub object: " + str(json_obj))
-        if 'status' in json_obj and json_obj['status'] == '404':
-            print("cannot access repo: " + repo_path + " with this key (unauthorized (404) for this resource)")
-        elif 'status' in json_obj and json_obj['status'] == '401':
-            print("cannot access repo: " + repo_path + " : bad credentials (401) (invalid github token)")
-        elif 'pushed_at' in json_obj and 'archived' in json_obj:
-            pushed_at_date = json_obj['pushed_at']
-            print(repo_path + " data is: " + pushed_at_date)
-
-            print("ARCHIVE STATUS: " + str(json_obj['archived']))
-            if json_obj['archived']:
-                if repo_path not in remote_repos_archived:
-                    remote_repos_archived.append(repo_path)
-
-            days_since_push = days_ago(datetime.strptime(pushed_at_date, "%Y-%m-%dT%H:%M:%SZ")) 
-            print(repo_path + " days since push is: " + str(days_since_push))
-
-            if days_since_push > 90:
-                remote_repos_stale.append(repo_path)
-                print("added to stale repos")
+        record_scm_repo_status(repo_path, fetch_scm_repo_status(get_github_client(), repo_path))
+
+# Ask for pushedAt/isArchived of a whole batch of repos in one aliased GraphQL query.
+# Replies are mapped back to the REST shape so record_scm_repo_status can read them.
+def fetch_scm_repo_statuses_graphql(client, repo_paths):
+    fields = []
+    for i, repo_path in enumerate(repo_paths):
+        github_Org, repo_name = github_repo_name(repo_path)
+        fields.append(f"r{i}: repository(owner: {json.dumps(github_Org)}, name: {json.dumps(repo_name)}) {{ pushedAt isArchived databaseId nameWithOwner }}")
+    # a batch of one owner's repos can go to that owner's App installation
+    owners = {github_repo_name(repo_path)[0] for repo_path in repo_paths}
+    extensions = {"github_owner": owners.pop()} if len(owners) == 1 else {}
+    response = client.post("/graphql", json={"query": "query { " + " ".join(fields) + " }"}, extensions=extensions)
+
+    if response.status_code == 401:
+        return {repo_path: {"status": "401"} for repo_path in repo_paths}
+    reply = response.json()
+    data = reply.get("data") or {}
+
+    # unresolvable repos come back as a null alias plus an error whose path names the alias
+    alias_errors = {}
+    for error in reply.get("errors", []):
+        if error.get("path"):
+            alias_errors[error["path"][0]] = error
+
+    statuses = {}
+    for i, repo_path in enumerate(repo_paths):
+        alias = f"r{i}"
+        repo = data.get(alias)
+        if repo is not None:
+            statuses[repo_path] = {"pushed_at": repo["pushedAt"], "archived": repo["isArchived"], "id": repo["databaseId"], "full_name": repo["nameWithOwner"]}
+        elif alias_errors.get(alias, {}).get("type") == "NOT_FOUND":
+            statuses[repo_path] = {"status": "404"}
+        else:
+            statuses[repo_path] = alias_errors.get(alias) or reply
+    return statuses
+
+def get_scm_repo_statuses_graphql(repo_paths):
+    # App installations only see their own org, so with any of them batch per owner
+    if any(credential.owner is not None for credential in github_credentials):
+        repo_paths_by_owner = {}
+        for repo_path in repo_paths:
+            repo_paths_by_owner.setdefault(github_repo_name(repo_path)[0], []).append(repo_path)
+        groups = list(repo_paths_by_owner.values())
+    else:
+        groups = [repo_paths]
+    batches = [group[i:i + github_graphql_batch] for group in groups for i in range(0, len(group), github_graphql_batch)]
+
+    client = get_github_client()
+    futures = {submit_lookup(fetch_scm_repo_statuses_graphql, client, batch): batch for batch in batches}
+    for future in as_completed(futures):
+        try:
+            statuses = future.result()
+        except (httpx.HTTPError, ValueError) as e:
+            for repo_path in futures[future]:
+                event_log.log("warning", "repo lookup failed", repo=repo_path, error=repr(e))
+            continue
+        for repo_path, json_obj in statuses.items():
+            record_scm_repo_status(repo_path, json_obj)
+
+# List every repo of a GitHub org (or user account) 100 at a time, following the Link header
+def fetch_github_org_repos(client, github_Org):
+    response = client.get(f"/orgs/{github_Org}/repos", params={"per_page": 100, "type": "all"})
+    if response.status_code == 404:
+        response = client.get(f"/users/{github_Org}/repos", params={"per_page": 100, "type": "all"})
+
+    repos = []
+    while response.status_code == 200:
+        repos.extend(response.json())
+        next_url = response.links.get("next", {}).get("url")
+        if next_url is None:
+            break
+        response = client.get(next_url)
+    return repos
+
+# Sweep the GitHub orgs with at least github_org_sweep_min_repos targets so far, each at most once
+# per run, and record the status of every target found in a swept org. Returns the repo paths
+# the sweeps did not cover, which still need a lookup of their own.
+def prefetch_github_org_repos(repo_paths):
+    repo_paths_by_org = {}
+    for repo_path in repo_paths:
+        github_Org, repo_name = github_repo_name(repo_path)
+        repo_paths_by_org.setdefault(github_Org, {}).setdefault(repo_name, []).append(repo_path)
+        github_org_targets[github_Org] += 1
+
+    new_orgs = [github_Org for github_Org in repo_paths_by_org
+                if github_Org not in swept_github_orgs and github_org_targets[github_Org] >= github_org_sweep_min_repos]
+    if new_orgs:
+        event_log.log("info", "github org sweep", github_orgs=len(new_orgs), repos=len(repo_paths))
+        client = get_github_client()
+        futures = {submit_lookup(fetch_github_org_repos, client, github_Org): github_Org for github_Org in new_orgs}
+        for future in as_completed(futures):
+            github_Org = futures[future]
+            try:
+                repos = future.result()
+            except (httpx.HTTPError, ValueError) as e:
+                event_log.log("warning", "github org sweep failed", github_org=github_Org, error=repr(e))
+                swept_github_orgs[github_Org] = None
+                continue
+            # only what record_scm_repo_status reads, as the sweeps are kept for the whole run
+            swept_github_orgs[github_Org] = {repo["name"].lower(): {"pushed_at": repo["pushed_at"], "archived": repo["archived"],
+                                                                    "id": repo.get("id"), "full_name": repo.get("full_name")} for repo in repos}
+
+    missed = []
+    for github_Org, repos in repo_paths_by_org.items():
+        swept = swept_github_orgs.get(github_Org)
+        for repo_name, paths in repos.items():
+            status = swept.get(repo_name) if swept else None
+            for repo_path in paths:
+                if status is None:
+                    missed.append(repo_path)
+                else:
+                    record_scm_repo_status(repo_path, status)
+    event_log.log("debug", "github org sweep done", covered=len(repo_paths) - len(missed), to_fetch=len(missed))
+    return missed
+
+# Look up many repos at once over the run's connection pool, github_workers at a time.
+# Results are recorded from this thread so the stale/archived lists are only touched here.
+def get_scm_repo_statuses(repo_paths):
+    repo_paths = [repo_path for repo_path in repo_paths if repo_path is not None and repo_index.key(repo_path) not in journal_repo_keys]
+    if not repo_paths:
+        return
+    if incremental:
+        now = time.time()
+        due = [repo_path for repo_path in repo_paths if repo_index.needs_refresh(repo_path, now)]
+        event_log.log("info", "incremental", due=len(due), repos=len(repo_paths))
+        repo_paths = due
+    if github_cache_file:
+        repo_paths = record_cached_repo_statuses(repo_paths)
+    if repo_paths and github_org_sweep:
+        repo_paths = prefetch_github_org_repos(repo_paths)
+    if not repo_paths:
+        return
+
+    if github_graphql:
+        get_scm_repo_statuses_graphql(repo_paths)
+        return
+
+    client = get_github_client()
+    futures = {submit_lookup(fetch_scm_repo_status, client, repo_path): repo_path for repo_path in repo_paths}
+    for future in as_completed(futures):
+        repo_path = futures[future]
+        try:
+            json_obj = future.result()
+        except (httpx.HTTPError, ValueError) as e:
+            event_log.log("warning", "repo lookup failed", repo=repo_path, error=repr(e))
+            continue
+        record_scm_repo_status(repo_path, json_obj)
+
+# GitHub sends pushed_at as epoch seconds in push events and as ISO 8601 elsewhere
+def github_timestamp(value):
+    if isinstance(value, int):
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(value))
+    return value
+
+# Re-list every org (with --trust-inventory, only those new or not listed for daemon_full_refresh),
+# then rebuild the repo -> projects and project id lookups from the warm per-org listings
+def refresh_inventory(rest_client):
+    global project_inventory, projects_by_id
+    now = time.time()
+    orgs = [org for org in iter_rest_items(rest_client, f"/orgs/") if in_shard(org["id"])]
+
+    relisted = 0
+    for org in orgs:
+        known = org_inventory.get(org["id"])
+        if trust_inventory and known is not None and now - known["listed_at"] < daemon_full_refresh:
+            continue
+        projects = stored_org_projects(org, now) if known is None else None
+        if projects is None:
+            projects = [pair for page in list_org_projects(rest_client, org) for pair in page]
+            store_org_projects(org, projects, now)
+            relisted += 1
+        org_inventory[org["id"]] = {"org": org, "listed_at": now, "projects": projects}
+    for org_id in set(org_inventory) - {org["id"] for org in orgs}:
+        del org_inventory[org_id]
+
+    # swapped in whole so the status endpoint never sees a half-built lookup
+    inventory, by_id = {}, {}
+    for entry in org_inventory.values():
+        for project, targetUrl in entry["projects"]:
+            by_id[project["id"]] = (entry["org"], project, targetUrl)
+            if targetUrl is not None:
+                inventory.setdefault(repo_index.key(targetUrl), []).append((entry["org"], project))
+    project_inventory, projects_by_id = inventory, by_id
+    event_log.log("info", "inventory refreshed", relisted=relisted, orgs=len(orgs), projects=len(by_id), repos=len(inventory))
+
+# Daemon reconciliation: refresh the inventory, look up the repos that are new or due,
+# and write only the projects whose state differs
+def reconcile(rest_client):
+    # every reconciliation sweeps the GitHub orgs afresh
+    swept_github_orgs.clear()
+    in_phase("list", refresh_inventory, rest_client)
+    repo_urls = {repo_index.key(targetUrl): targetUrl for _, _, targetUrl in projects_by_id.values() if targetUrl is not None}
+    in_phase("lookup", get_scm_repo_statuses, list(repo_urls.values()))
+    repo_index.classify()
+
+    lanes, workers, deactivations = start_apply_lanes()
+    for org, project, targetUrl in projects_by_id.values():
+        criticality, tags, deactivate = decide_project_change(org, project, targetUrl)
+        if tags is not None or deactivate:
+            org_lane(lanes, org["id"]).put(("project", org, project, criticality, tags, deactivate))
+    stop_apply_lanes(lanes, workers, deactivations)
+
+    if project_errors:
+        event_log.log("error", "reconciliation write failures", failed=len(project_errors))
+        project_errors.clear()
+    if github_cache_file:
+        save_github_cache(github_cache_file)
+    if repo_index_file:
+        repo_index.save(repo_index_file)
+    store_repo_statuses()
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # Access and error lines go to the event log instead of stderr
+    def log_message(self, format, *args):
+        event_log.log("debug", "http request", client=self.client_address[0], message=format % args)
+
+    # Current classification from memory: /status, /status/repo?url=<repo url>, /status/project/<id>
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == "/status":
+            self.reply_json({"orgs": len(org_inventory), "projects": len(projects_by_id), "repos": len(repo_index),
+                             "pending_events": webhook_events.qsize()})
+        elif parsed.path == "/status/repo":
+            repo_url = parse_qs(parsed.query).get("url", [""])[0]
+            entry = repo_index.get(repo_url) if repo_url else None
+            if entry is None:
+                self.reply(404)
+                return
+            projects = project_inventory.get(repo_index.key(repo_url), [])
+            self.reply_json({**entry, "key": repo_index.key(repo_url), "projects": [project["id"] for _, project in projects]})
+        elif parsed.path.startswith("/status/project/"):
+            found = projects_by_id.get(parsed.path[len("/status/project/"):])
+            if found is None:
+                self.reply(404)
+                return
+            org, project, targetUrl = found
+            self.reply_json({
+                "id": project["id"],
+                "name": project["attributes"]["name"],
+                "org_id": org["id"],
+                "target_url": targetUrl,
+                "business_criticality": project["attributes"].get("business_criticality"),
+                "tags": project["attributes"].get("tags"),
+                "status": project["attributes"].get("status"),
+                "repo": repo_index.get(targetUrl) if targetUrl is not None else None,
+            })
         else:
-            print("cannot access repo: " + repo_path + " - unknown reason - response:" + str(json_obj))
+            self.reply(404)
+
+    # Verify and queue the event; GitHub only waits 10 seconds for the reply
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/webhook":
+            self.reply(404)
+            return
+        if webhook_secret:
+            expected = "sha256=" + hmac.new(webhook_secret.encode(), body, hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(expected, self.headers.get("X-Hub-Signature-256", "")):
+                self.reply(401)
+                return
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.reply(400)
+            return
+        webhook_events.put((self.headers.get("X-GitHub-Event"), payload))
+        self.reply(202)
+
+    def reply_json(self, obj):
+        self.reply(200, json.dumps(obj).encode())
+
+    def reply(self, status_code, body=b""):
+        self.send_response(status_code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        return False
+
+# Update the repo from a push or (un)archive event and re-tag only the projects on it
+def handle_webhook_event(event, payload, v1_client):
+    repo = payload.get("repository")
+    if repo is None:
+        return
+    if event == "push":
+        pushed_at = github_timestamp(repo.get("pushed_at")) or time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        archived = repo.get("archived", False)
+    elif event == "repository" and payload.get("action") in ("archived", "unarchived"):
+        pushed_at = github_timestamp(repo["pushed_at"])
+        archived = payload["action"] == "archived"
+    else:
+        return
+
+    repo_url = repo["html_url"]
+    repo_index.record_status(repo_url, pushed_at, archived, repo.get("id"), repo.get("full_name"))
+    repo_index.classify()
+    projects = project_inventory.get(repo_index.key(repo_url)) or project_inventory.get(normalize_repo_url(repo_url), [])
+    event_log.log("info", "webhook event", github_event=event, repo=repo_url, archived=archived, stale=repo_index.is_stale(repo_url), projects=len(projects))
+
+    for org, project in projects:
+        criticality, tags, deactivate = decide_project_change(org, project, repo_url)
+        if tags is not None:
+            req = apply_criticality_to_project(get_snyk_write_client(), org["id"], project["id"], criticality, project["attributes"]["name"], tags)
+            if req.status_code in (200, 422):
+                project["attributes"].update(business_criticality=[criticality], tags=tags)
+                store_project(org["id"], project)
+        if deactivate:
+            event_log.log("debug", "deactivating", org=org["id"], project=project["id"])
+            v1_client.post(f"/org/{org['id']}/project/{project['id']}/deactivate", body={}, headers={"Content-Type": "application/vnd.api+json"})
+            project["attributes"]["status"] = "inactive"
+            store_project(org["id"], project)
+
+# Handles events one at a time, in the order they arrived; in daemon mode the same thread
+# reconciles every daemon_reconcile_interval seconds, so the two never race on the inventory
+def handle_webhook_events(rest_client, reconcile_interval):
+    v1_client = RateLimitedSnykClient(token, tries=tries, delay=delay, backoff=backoff, url=v1_snyk_url)
+    next_reconcile = time.time() + reconcile_interval if reconcile_interval else None
+    while True:
+        try:
+            item = webhook_events.get(timeout=max(next_reconcile - time.time(), 0) if next_reconcile else None)
+        except queue.Empty:
+            try:
+                reconcile(rest_client)
+            except Exception as e:
+                event_log.log("error", "reconciliation failed", error=repr(e))
+            next_reconcile = time.time() + reconcile_interval
+            continue
+
+        if item is None:
+            break
+        event, payload = item
+        try:
+            in_phase("webhook", handle_webhook_event, event, payload, v1_client)
+        except Exception as e:
+            event_log.log("error", "webhook event failed", github_event=event, error=repr(e))
+
+# Webhook mode lists the inventory once and then keeps tags current from GitHub events.
+# Daemon mode also reconciles the whole inventory on a schedule, keeping clients and state warm.
+def serve(reconcile_interval=None):
+    rest_client = RateLimitedSnykClient(token, tries=tries, delay=delay, backoff=backoff, version=apiVersion, url=snyk_url)
+    if reconcile_interval:
+        reconcile(rest_client)
+    else:
+        refresh_inventory(rest_client)
 
-        #line break for next project
-        print("\n")
+    host, port = webhook_listen.rsplit(":", 1)
+    server = ThreadingHTTPServer((host, int(port)), ServiceHandler)
+    worker = threading.Thread(target=handle_webhook_events, args=(rest_client, reconcile_interval), daemon=True)
+    worker.start()
+
+    event_log.log("info", "listening", webhook=f"http://{webhook_listen}/webhook", status=f"http://{webhook_listen}/status")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    webhook_events.put(None)
+    worker.join()
+
+# One run of the selected mode over this process's orgs; returns its summary
+def run_tagging():
+    global journal
+
+    if repo_index_file:
+        repo_index.load(repo_index_file)
+
+    if github_cache_file:
+        load_github_cache(github_cache_file)
+
+    start_profiling()
+
+    if inventory_db_file:
+        open_inventory_db(inventory_db_file)
+
+    if journal_file:
+        if os.path.exists(journal_file):
+            load_journal(journal_file)
+        journal = open(journal_file, "a")
+
+    if mode == "apply":
+        apply_plan(plan_file)
+    elif mode in ("webhook", "daemon"):
+        serve(daemon_reconcile_interval if mode == "daemon" else None)
+        if repo_index_file:
+            repo_index.save(repo_index_file)
+        store_repo_statuses()
+    else:
+        run_pipeline(plan_snyk_org_tags_rest if mode == "plan" else apply_snyk_org_tags_rest)
+        if github_cache_file:
+            save_github_cache(github_cache_file)
+        if repo_index_file:
+            repo_index.save(repo_index_file)
+        store_repo_statuses()
+
+    if snyk_write_client is not None:
+        snyk_write_client.close()
+    close_github_client()
+    if inventory_db is not None:
+        inventory_db.close()
+
+    # the run got through; the next one starts from scratch
+    if journal is not None:
+        journal.close()
+        if not project_errors:
+            os.remove(journal_file)
+
+    finish_profiling()
+    return run_summary()
+
+# Entry point of a worker process: its own orgs, state files and share of the rate limits
+def run_shard_process(process_index):
+    global shard_process, repo_index_file, github_cache_file, journal_file, plan_file, snyk_limiter, profile_dir
+    shard_process = process_index
+    # several processes would fight over one progress line, so each logs its progress as events
+    event_log.start(shard_path(log_file), log_level, progress_on_terminal=False)
+    if profile_dir:
+        profile_dir = os.path.join(profile_dir, f"process-{process_index + 1}")
+    repo_index_file, github_cache_file, journal_file = shard_path(repo_index_file), shard_path(github_cache_file), shard_path(journal_file)
+    if mode == "plan":
+        plan_file = shard_path(plan_file)
+    snyk_limiter = create_limiters(1 / (shard_count * shard_processes))
+    try:
+        return run_tagging()
+    finally:
+        event_log.stop()
+
+# Concatenate the plan files the worker processes wrote into plan_file
+def merge_plan_parts():
+    with open(plan_file, "w") as plan:
+        for shard_process_index in range(shard_processes):
+            part = f"{plan_file}.{shard_process_index + 1}-of-{shard_processes}"
+            with open(part) as plan_part:
+                plan.write(plan_part.read())
+            os.remove(part)
+
+def run_summary():
+    return {
+        "shards": [f"{shard_index + 1}/{shard_count}" + (f" process {shard_process + 1}/{shard_processes}" if shard_processes > 1 else "")],
+        "stats": dict(run_stats),
+        "errors": [list(error) for error in project_errors],
+        "github_rate_limit_wait": github_rate_limit_wait(),
+        "snyk_rate_limit_wait": snyk_limiter.slept,
+        "staleness": repo_index.statuses.report(time.time()),
+        "metrics": metrics.snapshot(),
+    }
+
+# Add up the summaries of several shards, from worker processes or --summary-file of other machines
+def merge_summaries(summaries):
+    merged = {"shards": [], "stats": Counter(), "errors": [], "github_rate_limit_wait": 0, "snyk_rate_limit_wait": 0, "staleness": {},
+              "metrics": {"calls": [], "latency": [], "retries": [], "phases": {}, "wall_time": 0}}
+    calls, latency, retries = Counter(), {}, Counter()
+    for summary in summaries:
+        for *key, count in summary["metrics"]["calls"]:
+            calls[tuple(key)] += count
+        for *key, histogram in summary["metrics"]["latency"]:
+            latency[tuple(key)] = [a + b for a, b in zip(latency.get(tuple(key), [0] * len(histogram)), histogram)]
+        for *key, count in summary["metrics"]["retries"]:
+            retries[tuple(key)] += count
+        # shards run side by side, so a phase took as long as its slowest shard
+        for phase, seconds in summary["metrics"]["phases"].items():
+            merged["metrics"]["phases"][phase] = max(merged["metrics"]["phases"].get(phase, 0), seconds)
+        merged["metrics"]["wall_time"] = max(merged["metrics"]["wall_time"], summary["metrics"]["wall_time"])
+        for org, org_report in summary["staleness"].items():
+            merged_report = merged["staleness"].setdefault(org, {"repos": 0, "stale": 0, "archived": 0, "days": Counter()})
+            for count in ("repos", "stale", "archived"):
+                merged_report[count] += org_report[count]
+            merged_report["days"].update({int(day): repos for day, repos in org_report["days"].items()})
+        merged["shards"].extend(summary["shards"])
+        merged["stats"].update(summary["stats"])
+        merged["errors"].extend(summary["errors"])
+        merged["github_rate_limit_wait"] += summary["github_rate_limit_wait"]
+        merged["snyk_rate_limit_wait"] += summary["snyk_rate_limit_wait"]
+    merged["stats"] = dict(merged["stats"])
+    merged["metrics"].update(calls=[[*key, count] for key, count in calls.items()], latency=[[*key, histogram] for key, histogram in latency.items()],
+                             retries=[[*key, count] for key, count in retries.items()])
+    return merged
+
+# Percentiles and histogram of days since push per GitHub org, from the summary's day counts
+def print_staleness_report(staleness):
+    labels = [f"<={bound}d" for bound in staleness_buckets] + [f">{staleness_buckets[-1]}d"]
+    print(f"{'GitHub org':<30} {'repos':>7} {'stale':>7} {'archived':>8} {'p50':>6} {'p90':>6} {'p99':>6} {'max':>6}  " + " ".join(f"{label:>7}" for label in labels))
+    for org, org_report in sorted(staleness.items()):
+        days = Counter({int(day): repos for day, repos in org_report["days"].items()})
+        values = sorted(days.elements())
+        p50, p90, p99 = (statistics.quantiles(values, n=100, method="inclusive")[i] for i in (49, 89, 98)) if len(values) > 1 else values * 3
+        histogram = Counter()
+        for day, repos in days.items():
+            histogram[next((i for i, bound in enumerate(staleness_buckets) if day <= bound), len(staleness_buckets))] += repos
+        print(f"{org:<30} {org_report['repos']:>7} {org_report['stale']:>7} {org_report['archived']:>8} {p50:>6.0f} {p90:>6.0f} {p99:>6.0f} {values[-1]:>6}  "
+              + " ".join(f"{histogram[i]:>7}" for i in range(len(labels))))
+
+# Calls, retries and the median latency per endpoint family, and how long each phase ran
+def print_metrics(run_metrics, stats):
+    wall_time = run_metrics["wall_time"]
+    print(f"{wall_time:.1f}s wall time, {stats['projects']} projects ({stats['projects'] / max(wall_time, 0.001):.1f}/s); phases: "
+          + ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in sorted(run_metrics["phases"].items(), key=lambda item: -item[1])))
+
+    endpoints = {}
+    for api, endpoint, phase, status, count in run_metrics["calls"]:
+        endpoints.setdefault((api, endpoint), Counter())[status] += count
+    latency = {}
+    for api, endpoint, phase, histogram in run_metrics["latency"]:
+        latency[(api, endpoint)] = [a + b for a, b in zip(latency.get((api, endpoint), [0] * len(histogram)), histogram)]
+    retries, hedges = Counter(), Counter()
+    for api, endpoint, reason, count in run_metrics["retries"]:
+        if reason.startswith("hedge"):
+            hedges[(api, endpoint, reason)] += count
+        else:
+            retries[(api, endpoint)] += count
+
+    for key, statuses in sorted(endpoints.items()):
+        histogram = latency.get(key, [0] * (len(latency_buckets) + 2))
+        calls = sum(histogram[:-1])
+        # upper bound of the bucket holding the median call
+        median = next((bound for bound, seen in zip(latency_buckets + [float("inf")], itertools.accumulate(histogram[:-1])) if seen * 2 >= calls), 0)
+        print(f"  {key[0]} {key[1]}: {sum(statuses.values())} calls ({', '.join(f'{count} x {status}' for status, count in sorted(statuses.items()))}), "
+              f"{retries[key]} retries, {hedges[(*key, 'hedge')]} hedged ({hedges[(*key, 'hedge won')]} won), mean {histogram[-1] / max(calls, 1) * 1000:.0f}ms, median <= {median * 1000:.0f}ms")
+
+def prometheus_labels(**labels):
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in labels.items()) + "}"
+
+# Write the summary's metrics in the Prometheus text format, for node_exporter's textfile collector
+def write_prometheus_textfile(path, summary):
+    run_metrics = summary["metrics"]
+    stats = Counter(summary["stats"])
+    lines = [
+        "# HELP snyk_tagging_api_calls_total API calls by API, endpoint family, phase and status code",
+        "# TYPE snyk_tagging_api_calls_total counter",
+    ]
+    for api, endpoint, phase, status, count in run_metrics["calls"]:
+        lines.append(f"snyk_tagging_api_calls_total{prometheus_labels(api=api, endpoint=endpoint, phase=phase, status=status)} {count}")
+
+    lines += ["# HELP snyk_tagging_api_call_duration_seconds API call latency by API, endpoint family and phase",
+              "# TYPE snyk_tagging_api_call_duration_seconds histogram"]
+    for api, endpoint, phase, histogram in run_metrics["latency"]:
+        labels = dict(api=api, endpoint=endpoint, phase=phase)
+        for bound, count in zip(latency_buckets + ["+Inf"], itertools.accumulate(histogram[:-1])):
+            lines.append(f"snyk_tagging_api_call_duration_seconds_bucket{prometheus_labels(**labels, le=bound)} {count}")
+        lines.append(f"snyk_tagging_api_call_duration_seconds_sum{prometheus_labels(**labels)} {histogram[-1]}")
+        lines.append(f"snyk_tagging_api_call_duration_seconds_count{prometheus_labels(**labels)} {sum(histogram[:-1])}")
+
+    lines += ["# HELP snyk_tagging_api_retries_total API calls sent again, by API, endpoint family and reason",
+              "# TYPE snyk_tagging_api_retries_total counter"]
+    for api, endpoint, reason, count in run_metrics["retries"]:
+        lines.append(f"snyk_tagging_api_retries_total{prometheus_labels(api=api, endpoint=endpoint, reason=reason)} {count}")
+
+    lines += ["# HELP snyk_tagging_rate_limit_wait_seconds Time spent waiting for the API rate limits",
+              "# TYPE snyk_tagging_rate_limit_wait_seconds gauge",
+              f"snyk_tagging_rate_limit_wait_seconds{prometheus_labels(api='github')} {summary['github_rate_limit_wait']}",
+              f"snyk_tagging_rate_limit_wait_seconds{prometheus_labels(api='snyk')} {summary['snyk_rate_limit_wait']}",
+              "# HELP snyk_tagging_phase_duration_seconds Wall time from the start to the end of each phase",
+              "# TYPE snyk_tagging_phase_duration_seconds gauge"]
+    for phase, seconds in run_metrics["phases"].items():
+        lines.append(f"snyk_tagging_phase_duration_seconds{prometheus_labels(phase=phase)} {seconds}")
+
+    lines += ["# HELP snyk_tagging_run_stat_total Counts of the run summary (projects, writes sent and skipped, ...)",
+              "# TYPE snyk_tagging_run_stat_total counter"]
+    for stat, count in stats.items():
+        lines.append(f"snyk_tagging_run_stat_total{prometheus_labels(stat=stat)} {count}")
+    lines += ["# TYPE snyk_tagging_project_errors gauge", f"snyk_tagging_project_errors {len(summary['errors'])}",
+              "# TYPE snyk_tagging_run_duration_seconds gauge", f"snyk_tagging_run_duration_seconds {run_metrics['wall_time']}",
+              "# TYPE snyk_tagging_projects_per_second gauge", f"snyk_tagging_projects_per_second {stats['projects'] / max(run_metrics['wall_time'], 0.001)}",
+              "# TYPE snyk_tagging_last_run_timestamp_seconds gauge", f"snyk_tagging_last_run_timestamp_seconds {time.time()}"]
+
+    # written aside and renamed, so the collector never reads half a file
+    with open(path + ".tmp", "w") as textfile:
+        textfile.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
+
+def print_summary(summary):
+    stats = Counter(summary["stats"])
+    if len(summary["shards"]) > 1:
+        print(f"summary of {len(summary['shards'])} shards: {', '.join(summary['shards'])}")
+    print(f"waited {summary['github_rate_limit_wait']:.0f}s for the GitHub rate limit and {summary['snyk_rate_limit_wait']:.0f}s for the Snyk rate limit")
+    if stats["planned changes"]:
+        print(f"{stats['planned changes']} project changes planned")
+    if mode != "plan":
+        print(f"{stats['project writes']} project writes sent, {stats['project writes skipped']} skipped (already up to date)")
+        print(f"{stats['deactivations']} projects on archived repos deactivated and verified, {stats['already inactive']} already inactive")
+    print_metrics(summary["metrics"], stats)
+    if summary["staleness"]:
+        print_staleness_report(summary["staleness"])
+    if summary["errors"]:
+        print(f"{len(summary['errors'])} project writes failed:")
+        for org_id, project_id, project_name, error in summary["errors"]:
+            print(f"  org {org_id} project {project_name} ({project_id}): {error}")
 
 if __name__ == '__main__':
     # Parsing Command Line Arguments
@@ -282,11 +2468,185 @@ if __name__ == '__main__':
         description='Tag Github With Snyk Targets')
     # Required fields:
 
-    orgs = []
-    count = 0
-    projects = get_org_projects_rest()
+    # Optional fields:
+    parser.add_argument('--github-workers', type=int, default=github_workers,
+        help='number of GitHub repo lookups to run concurrently (default: %(default)s)')
+    parser.add_argument('--github-graphql', action='store_true',
+        help=f'look repos up with batched GraphQL queries ({github_graphql_batch} repos per request) instead of REST')
+    parser.add_argument('--github-org-sweep', action='store_true',
+        help=f'list the repos of every GitHub org with at least {github_org_sweep_min_repos} targets before looking up the rest one by one')
+    parser.add_argument('--github-app-id', default=github_app_id,
+        help='GitHub App whose installation tokens are used for lookups, alongside GITHUB_TOKEN/GITHUB_TOKENS (env: GITHUB_APP_ID)')
+    parser.add_argument('--github-app-key', metavar='PATH', default=github_app_key_file,
+        help='private key file of the GitHub App (env: GITHUB_APP_PRIVATE_KEY_FILE)')
+    parser.add_argument('--github-cache', metavar='PATH',
+        help='keep GitHub repo statuses in this file between runs and revalidate them with ETags')
+    parser.add_argument('--github-cache-ttl', type=float, default=github_cache_ttl / 3600,
+        help='hours a cached repo status is used without asking GitHub (default: %(default)s)')
+    parser.add_argument('--github-cache-max-entries', type=int, default=github_cache_max_entries,
+        help='maximum number of cached repo statuses, oldest are evicted first (default: %(default)s)')
+    parser.add_argument('--repo-index', metavar='PATH',
+        help='load the repo index (URL variants, GitHub ids, statuses) from this file and save it back after the lookups')
+    parser.add_argument('--incremental', action='store_true',
+        help='only look up repos that are new, due to turn stale, or past --max-age-days (needs --repo-index or --inventory-db)')
+    parser.add_argument('--stale-days', type=int, default=stale_days,
+        help='days without a push after which a repo is tagged inactive (default: %(default)s)')
+    parser.add_argument('--org-stale-days', metavar='ORG=DAYS', action='append', default=[],
+        help='stale threshold for the repos of one GitHub org, overriding --stale-days (repeatable)')
+    parser.add_argument('--max-age-days', type=float, default=incremental_max_age / (24 * 60 * 60),
+        help='with --incremental, look up every repo at least this often (default: %(default)s)')
+    parser.add_argument('--queue-size', type=int, default=pipeline_queue_size,
+        help='items buffered between pipeline stages (default: %(default)s)')
+    parser.add_argument('--lookup-window-seconds', type=float, default=lookup_batch_window,
+        help='seconds the lookup stage waits to gather a full batch of new repos before looking up fewer (default: %(default)s)')
+    parser.add_argument('--apply-workers', type=int, default=snyk_apply_workers,
+        help='number of Snyk project writes to run concurrently (default: %(default)s)')
+    parser.add_argument('--deactivate-workers', type=int, default=snyk_deactivate_workers,
+        help='number of project deactivations (projects on archived repos) to run concurrently (default: %(default)s)')
+    parser.add_argument('--snyk-rate-limit', type=int, default=snyk_rate_limit,
+        help='Snyk API requests per minute shared by all workers (default: %(default)s)')
+    parser.add_argument('--connect-timeout', type=float, default=connect_timeout,
+        help='seconds to connect to Snyk or GitHub (default: %(default)s)')
+    parser.add_argument('--read-timeout', type=float, default=read_timeout,
+        help='seconds to wait for each read of a response (default: %(default)s)')
+    parser.add_argument('--deadline', type=float, default=request_deadline,
+        help='seconds a request may take in total, retries and hedged tries included, rate limit waits not (default: %(default)s)')
+    parser.add_argument('--hedge-percentile', type=float, default=hedge_percentile,
+        help='send a second try of a GET or PATCH that is slower than this percentile of its endpoint\'s recent latencies; 0 turns hedging off (default: %(default)s)')
+    parser.add_argument('--mode', choices=['run', 'plan', 'apply', 'webhook', 'daemon'], default=mode,
+        help='run: read and tag in one pass; plan: write the changes to --plan-file without applying them; '
+             'apply: apply the changes in --plan-file; webhook: re-tag projects as GitHub push and '
+             'archive events arrive; daemon: webhook mode plus a reconciliation every --reconcile-minutes '
+             '(default: %(default)s)')
+    parser.add_argument('--plan-file', metavar='PATH', default=plan_file,
+        help='change plan written by plan mode and read by apply mode (default: %(default)s)')
+    parser.add_argument('--listen', metavar='HOST:PORT', default=webhook_listen,
+        help='address the webhook receiver listens on (default: %(default)s)')
+    parser.add_argument('--reconcile-minutes', type=float, default=daemon_reconcile_interval / 60,
+        help='minutes between reconciliations in daemon mode (default: %(default)s)')
+    parser.add_argument('--full-refresh-hours', type=float, default=daemon_full_refresh / 3600,
+        help='hours an org listing is served with --trust-inventory before the org is re-listed (default: %(default)s)')
+    parser.add_argument('--inventory-db', metavar='PATH',
+        help='keep orgs, targets, projects and repo statuses in this SQLite database')
+    parser.add_argument('--trust-inventory', action='store_true',
+        help='serve orgs listed less than --full-refresh-hours ago from the inventory (daemon memory or --inventory-db) '
+             'instead of re-listing them; projects added or changed since are missed until then')
+    parser.add_argument('--journal', metavar='PATH',
+        help='checkpoint progress to this file; if it exists, resume the interrupted run it belongs to')
+    parser.add_argument('--shard', metavar='I/N', default='1/1',
+        help='only process the I-th of N deterministic slices of the group\'s orgs, to split a run across machines')
+    parser.add_argument('--processes', type=int, default=1,
+        help='split this machine\'s orgs across this many worker processes; rate limits are divided evenly '
+             'between all shards and processes (default: %(default)s)')
+    parser.add_argument('--summary-file', metavar='PATH',
+        help='also write the run summary to this file as JSON')
+    parser.add_argument('--profile', metavar='DIR',
+        help='write a cProfile dump per phase, tracemalloc snapshots at phase boundaries and the peak RSS to this run directory')
+    parser.add_argument('--metrics-file', metavar='PATH',
+        help='write API call counts, latency histograms, retries, rate-limit waits and phase timings to this Prometheus textfile')
+    parser.add_argument('--log-file', metavar='PATH',
+        help='write the JSONL event log to this file instead of stdout; with --processes, one file per process')
+    parser.add_argument('--log-level', choices=list(log_levels), default=log_level,
+        help='least severe events logged; debug adds the full org, project and response payloads (default: %(default)s)')
+    parser.add_argument('--progress-seconds', type=float, default=progress_interval,
+        help='seconds between progress updates on stderr, or progress events when stderr is not a terminal; 0 turns them off (default: %(default)s)')
+    parser.add_argument('--merge-summaries', nargs='+', metavar='PATH',
+        help='print the merged summary of the given --summary-file outputs of several shards and exit')
+    args = parser.parse_args()
+
+    if args.merge_summaries:
+        summaries = []
+        for path in args.merge_summaries:
+            with open(path) as summary_input:
+                summaries.append(json.load(summary_input))
+        summary = merge_summaries(summaries)
+        print_summary(summary)
+        if args.metrics_file:
+            write_prometheus_textfile(args.metrics_file, summary)
+        exit()
+
+    github_workers = args.github_workers
+    github_graphql = args.github_graphql
+    github_org_sweep = args.github_org_sweep
+    github_cache_file = args.github_cache
+    github_cache_ttl = args.github_cache_ttl * 3600
+    github_cache_max_entries = args.github_cache_max_entries
+    repo_index_file = args.repo_index
+    incremental = args.incremental
+    incremental_max_age = args.max_age_days * 24 * 60 * 60
+    stale_days = args.stale_days
+    for org_threshold in args.org_stale_days:
+        org, days = org_threshold.split("=")
+        org_stale_days[org.lower()] = int(days)
+    if incremental and not (repo_index_file or args.inventory_db):
+        parser.error("--incremental needs --repo-index or --inventory-db to keep the due dates between runs")
+    pipeline_queue_size = args.queue_size
+    lookup_batch_window = args.lookup_window_seconds
+    snyk_apply_workers = args.apply_workers
+    snyk_deactivate_workers = args.deactivate_workers
+    snyk_rate_limit = args.snyk_rate_limit
+    connect_timeout = args.connect_timeout
+    read_timeout = args.read_timeout
+    request_deadline = args.deadline
+    hedge_percentile = args.hedge_percentile
+    journal_file = args.journal
+    mode = args.mode
+    plan_file = args.plan_file
+    webhook_listen = args.listen
+    daemon_reconcile_interval = args.reconcile_minutes * 60
+    daemon_full_refresh = args.full_refresh_hours * 3600
+    trust_inventory = args.trust_inventory
+    if mode == "daemon":
+        # the daemon's repo statuses stay warm in memory; only new and due repos are looked up again
+        incremental = True
+    summary_file = args.summary_file
+    metrics_file = args.metrics_file
+    profile_dir = args.profile
+    inventory_db_file = args.inventory_db
+
+    try:
+        shard_index, shard_count = (int(part) for part in args.shard.split("/"))
+        shard_index -= 1
+    except ValueError:
+        parser.error("--shard must look like I/N, e.g. 2/4")
+    if not 0 <= shard_index < shard_count:
+        parser.error("--shard I/N needs 1 <= I <= N")
+    shard_processes = args.processes
+    if shard_processes > 1 and mode in ("webhook", "daemon"):
+        parser.error("--processes can't be used with webhook or daemon mode")
+    # unsigned events can deactivate projects, so only a loopback receiver may go without a secret
+    if mode in ("webhook", "daemon") and not webhook_secret and not is_loopback(webhook_listen.rsplit(":", 1)[0]):
+        parser.error("webhook and daemon mode need GITHUB_WEBHOOK_SECRET unless --listen is a loopback address")
+    log_file = args.log_file
+    log_level = args.log_level
+    progress_interval = args.progress_seconds
+    event_log.start(log_file, log_level)
+
+    github_app_id = args.github_app_id
+    github_app_key_file = args.github_app_key
+    github_credentials = load_github_credentials()
+    snyk_limiter = create_limiters(1 / shard_count)
+
+    try:
+        if args.processes > 1:
+            # the workers start their own event logs; a writer thread must not be mid-write when they fork
+            event_log.stop()
+            # fork, so the workers start from the settings parsed above
+            with multiprocessing.get_context("fork").Pool(shard_processes) as pool:
+                summary = merge_summaries(pool.map(run_shard_process, range(shard_processes)))
+            if mode == "plan":
+                merge_plan_parts()
+        else:
+            summary = run_tagging()
+    finally:
+        event_log.stop()
 
-    apply_snyk_org_tags_rest()    
+    print_summary(summary)
+    if summary_file:
+        with open(summary_file, "w") as summary_output:
+            json.dump(summary, summary_output, indent=2)
+    if metrics_file:
+        write_prometheus_textfile(metrics_file, summary)
 
     # print count of issues with description of filter criteria from arguments
     print(f"\n")